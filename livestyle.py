@@ -33,15 +33,18 @@ import lsutils.reloader
 
 import lsutils.editor as eutils
 import lsutils.diff
+import lsutils.textdiff
 import lsutils.websockets as ws
+import lsutils.wire as wire
 import lsutils.webkit_installer
+from lsutils.file_registry import FileRegistry
 
 sublime_ver = int(sublime.version()[0])
 
 _suppressed = set()
 
-# List of all opened views and their file names
-_view_file_names = {}
+# Opened CSS files, known by connected clients
+_files = FileRegistry()
 
 # Create logger
 logger = logging.getLogger('livestyle')
@@ -55,22 +58,49 @@ if not logger.handlers:
 @eutils.main_thread
 def identify_editor(socket):
 	"Sends editor identification info to browser"
+	sync_files(exclude=socket)
 	ws.send({
 		'action': 'id',
 		'data': {
 			'id': 'st%d' % sublime_ver,
 			'title': 'Sublime Text %d' % sublime_ver,
 			'icon': 'data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAABAAAAAQCAYAAAAf8/9hAAABu0lEQVR42q2STWsTURhG3WvdCyq4CEVBAgYCM23JjEwy+cJC41gRdTIEGyELU7BNNMJQhUBBTUjSRdRI3GThRld+gbj2JwhuRFy5cZ3Ncd5LBwZCIIIXDlzmeZ9z4d458t9WoVB4XywWCcnn89i2TSaTIZvNEuRhJvtP0e7R6XT6VYJer8dkMmE0GrHf3uPxg1s8f+TR9ncZDocq63a7SiId6YogBqiPg8FASe43d3iz7/D7rcuP1zf4NnHxfV9yQc0CSFcEeihotVo0Gg22tzbh3SbP7lq4lzTuuHlqtZrkQlSgi8AIBZVKBc/zuH5lnc7tFX4OL/L9wOTJlsbGepFyuSwzUYERCqIXhGVZJJNJbqbP0b66DC8ucO/yedLptMzMF4S3X7JXeFWJ4Zln2LZPw9NT+BuxxQTquaw1Xl47yZ/WEr92j3PgnMBc08nlcvMF1Wo1DNW7G4aBpmnouo5pmtGyzM4K+v0+4/F4ITqdzqzAdV0cxyGVSsmpc5G/s1QqzQg+N5tNdUmJRIJ4PD4XkdTrdaQTClYDlvnHFXTOqu7h5mHAx4AvC/IhYE+6IliK2IwFWT3sHPsL6BnLQ4kfGmsAAAAASUVORK5CYII=',
-			'files': eutils.css_files()
+			'files': _files.files,
+			'filesVersion': _files.version,
+			'supports': [wire.FEATURE]
 		}
 	}, socket)
 
+def send_files_delta(delta, exclude=None):
+	"""
+	Sends file list changes to clients: clients that support
+	deltas receive changes only, others receive full file list
+	"""
+	clients = [c for c in ws.clients() if c != exclude]
+	delta_clients = [c for c in clients if ws.supports(c, 'filesDelta')]
+	legacy_clients = [c for c in clients if c not in delta_clients]
+
+	if delta_clients:
+		ws.send({
+			'action': 'filesDelta',
+			'data': delta
+		}, delta_clients)
+
+	if legacy_clients and 'renamed' not in delta:
+		ws.send({
+			'action': 'updateFiles',
+			'data': _files.files
+		}, legacy_clients)
+
+def sync_files(exclude=None):
+	"Updates list of opened CSS files and notifies clients about changes"
+	delta = _files.update(eutils.css_files())
+	if delta:
+		send_files_delta(delta, exclude)
+
 @eutils.main_thread
 def update_files():
-	ws.send({
-		'action': 'updateFiles',
-		'data': eutils.css_files()
-	})
+	sync_files()
 
 def send_patches(buf_id=None, p=None):
 	if not buf_id or not p:
@@ -131,7 +161,18 @@ def send_unsaved_files(payload, sender):
 	else:
 		logger.info('No unsaved changes')
 
+def merge_patch_requests(prev, cur):
+	"Merges consecutive patch requests for the same editor file"
+	prev_payload, cur_payload = prev[0], cur[0]
+	if not prev_payload.get('editorFile') or prev_payload.get('editorFile') != cur_payload.get('editorFile'):
+		return None
+
+	payload = dict(cur_payload)
+	payload['patch'] = (eutils.parse_json(prev_payload.get('patch')) or []) + (eutils.parse_json(cur_payload.get('patch')) or [])
+	return (payload,) + tuple(cur[1:])
+
 @eutils.main_thread
+@eutils.merge_calls(merge_patch_requests)
 def handle_patch_request(payload, sender):
 	logger.debug('Handle CSS patch request')
 
@@ -198,46 +239,62 @@ def suppress_update(view):
 
 class LivestyleListener(sublime_plugin.EventListener):
 	def on_new(self, view):
-		_view_file_names[view.id()] = eutils.file_name(view)
+		eutils.index_view(view)
+		eutils.remember_file_name(view)
 
 		if eutils.is_css_view(view):
 			update_files()
 
 	def on_load(self, view):
-		_view_file_names[view.id()] = eutils.file_name(view)
+		eutils.index_view(view)
+		eutils.remember_file_name(view)
 
 		if eutils.is_css_view(view):
 			update_files()
 
 	def on_close(self, view):
-		if view.id() in _view_file_names:
-			del _view_file_names[view.id()]
+		eutils.unindex_view(view)
+
+		# release buffer data if there are no more views (clones) of it
+		buf_id = view.buffer_id()
+		if not eutils.has_views(buf_id):
+			lsutils.diff.release(buf_id)
 
 		update_files()
 
 	def on_modified(self, view):
 		if should_handle(view):
 			logger.debug('Run diff')
+			lsutils.diff.mark_modified(view.buffer_id(), view)
 			lsutils.diff.diff(view.buffer_id())
 
 	def on_activated(self, view):
+		eutils.index_view(view)
 		if eutils.is_css_view(view, True):
 			logger.debug('Prepare diff')
 			update_files()
 			lsutils.diff.prepare_diff(view.buffer_id())
 
+	def on_deactivated(self, view):
+		if eutils.is_css_view(view, True):
+			lsutils.diff.deactivate(view.buffer_id())
+
 	def on_post_save(self, view):
-		k = view.id()
+		eutils.index_view(view)
+		old_name = eutils.renamed_file(view)
 		new_name = eutils.file_name(view)
-		if k in _view_file_names and _view_file_names[k] != new_name:
+		if old_name:
 			ws.send({
 				'action': 'renameFile',
 				'data': {
-					'oldname': _view_file_names[k],
+					'oldname': old_name,
 					'newname': new_name
 				}
 			})
-			_view_file_names[k] = new_name
+
+			delta = _files.rename(old_name, new_name)
+			if delta:
+				send_files_delta(delta)
 
 
 class LivestyleReplaceContentCommand(sublime_plugin.TextCommand):
@@ -246,28 +303,36 @@ class LivestyleReplaceContentCommand(sublime_plugin.TextCommand):
 		if not payload:
 			return
 
-		suppress_update(self.view)
-		s = self.view.sel()[0]
-		sels = [[s.a, s.a]]
-		
 		try:
 			payload = eutils.parse_json(payload)
 		except:
 			payload = {'content': payload, 'selection': None}
 
+		if 'edits' in payload:
+			return self.apply_edits(edit, payload['edits'])
+
 		# if sublime_ver < 3:
 		#	payload['content'] = payload.get('content', u'').decode('utf-8')
 
-		self.view.replace(edit, sublime.Region(0, self.view.size()), payload.get('content', ''))
+		# replace changed fragments only to keep syntax highlighting
+		# and undo history of the rest of the document
+		self.apply_edits(edit, lsutils.textdiff.edits(eutils.content(self.view), payload.get('content', '')))
 
+		# selections outside of changed fragments are preserved by editor
 		if payload.get('selection'):
-			sels = [payload.get('selection')]
-
-		self.view.sel().clear()
-		for s in sels:
+			s = payload.get('selection')
+			self.view.sel().clear()
 			self.view.sel().add(sublime.Region(s[0], s[1]))
+			self.view.show(self.view.sel())
 
-		self.view.show(self.view.sel())
+	def apply_edits(self, edit, edits):
+		"Applies list of `[start, end, text]` edits one by one"
+		if not edits:
+			return
+
+		suppress_update(self.view)
+		for start, end, text in edits:
+			self.view.replace(edit, sublime.Region(start, end), text)
 
 class LivestyleInstallWebkitExt(sublime_plugin.ApplicationCommand):
 	def run(self, *args, **kw):
@@ -323,12 +388,14 @@ def unload_handler():
 	ws.stop()
 
 def start_plugin():
-	ws.start(int(eutils.get_setting('port')))
+	compression = eutils.get_setting('compression', False)
+	if compression is True:
+		compression = {}
+	ws.start(int(eutils.get_setting('port')), compression or None)
 	logger.setLevel(logging.DEBUG if eutils.get_setting('debug', False) else logging.INFO)
 
 	# collect all view's file paths
-	for view in eutils.all_views():
-		_view_file_names[view.id()] = eutils.file_name(view)
+	eutils.reindex_views()
 
 
 def plugin_loaded():
@@ -0,0 +1,52 @@
+"""
+Per-buffer cache of parsed stylesheets. Cached stylesheets are
+updated incrementally: only top-level rules affected by
+edit are re-parsed.
+
+Parsed stylesheet takes about ten times more memory than its source,
+so only stylesheets of a few recently used buffers are kept
+"""
+
+import lsutils.css_parser as css_parser
+
+# Maximum number of cached stylesheets
+limit = 3
+
+_cache = {}
+# buffer ids, least recently used first
+_order = []
+_evict_listeners = []
+
+def get(buf_id, source, changed=None):
+	"""
+	Returns parsed stylesheet for given buffer source.
+	`changed` is an optional `(start, old_end, new_end)` range
+	of text changed since the last call
+	@return: css_parser.Stylesheet
+	"""
+	sheet = css_parser.update(_cache.get(buf_id), source, changed)
+	put(buf_id, sheet)
+	return sheet
+
+def put(buf_id, sheet):
+	"Stores parsed stylesheet for given buffer"
+	_cache[buf_id] = sheet
+	if buf_id in _order:
+		_order.remove(buf_id)
+	_order.append(buf_id)
+
+	while limit and len(_order) > limit:
+		evicted = _order.pop(0)
+		del _cache[evicted]
+		for callback in _evict_listeners:
+			callback(evicted)
+
+def on_evict(callback):
+	"Adds listener called with buffer id when its stylesheet is evicted"
+	_evict_listeners.append(callback)
+
+def remove(buf_id):
+	"Removes cached stylesheet of given buffer"
+	if buf_id in _cache:
+		del _cache[buf_id]
+		_order.remove(buf_id)
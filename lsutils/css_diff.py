@@ -0,0 +1,203 @@
+"""
+Structural CSS diff: compares two parsed CSS trees and produces
+LiveStyle patches, the same ones that browser worker produces.
+
+Each patch is a dict with the following keys:
+* `path`: list of `[name, pos]` pairs that locates rule in tree,
+  where `pos` is 1-based index of rule among siblings with the same name
+* `action`: either `add`, `update` or `remove`
+* `properties`: list of added or updated properties, each
+  is a `{name, value, index}` dict (`update` action of rule only)
+* `removed`: list of removed properties (`update` action of rule only)
+* `value`: value of block-less at-rule like `@import`, these are
+  compared by value instead of properties (`add` and `update` actions)
+"""
+
+import bisect
+
+def diff(old_tree, new_tree, changed=None):
+	"""
+	Returns list of patches required to transform `old_tree`
+	into `new_tree`. If `changed` range is given as
+	`(start, old_end, new_end)` tuple, only top-level rules
+	intersecting this range are compared
+	@type old_tree: css_parser.Stylesheet
+	@type new_tree: css_parser.Stylesheet
+	"""
+	if changed is None:
+		old_rules = rule_list(old_tree.rules())
+		new_rules = rule_list(new_tree.rules())
+	else:
+		old_rules, new_rules = changed_rule_lists(old_tree, new_tree, changed)
+
+	old_lookup = dict(old_rules)
+	new_lookup = dict(new_rules)
+	patches = []
+
+	for path, node in new_rules:
+		prev = old_lookup.get(path)
+		if node.type == 'at-rule':
+			if prev is None:
+				patches.append(make_patch(path, 'add', value=node.value))
+			elif prev.type != node.type or prev.value != node.value:
+				patches.append(make_patch(path, 'update', value=node.value))
+			continue
+
+		if prev is None:
+			updated = property_list(node)
+			removed = []
+		else:
+			updated, removed = diff_properties(prev, node)
+
+		if prev is None or updated or removed:
+			patches.append(make_patch(path, 'update', updated, removed))
+
+	removed_paths = []
+	for path, node in old_rules:
+		if path in new_lookup:
+			continue
+
+		# no need to remove rule if its parent is already removed
+		if any(path[:len(p)] == p for p in removed_paths):
+			continue
+
+		removed_paths.append(path)
+		patches.append(make_patch(path, 'remove'))
+
+	return patches
+
+def changed_rule_lists(old_tree, new_tree, changed):
+	"""
+	Returns rule lists of both trees limited to top-level rules
+	that intersect changed range
+	"""
+	start, old_end, new_end = changed
+	old_first, old_last = affected_nodes(old_tree, start, old_end)
+	new_first = affected_nodes(new_tree, start, new_end)[0]
+	first = min(old_first, new_first)
+
+	# Incrementally updated tree shares unchanged nodes with its
+	# previous revision. Changed range may affect structure of the
+	# following nodes as well, so make sure unchanged nodes are
+	# actually shared, otherwise compare the rest of the trees
+	while first > 0 and old_tree.nodes[first - 1] is not new_tree.nodes[first - 1]:
+		first -= 1
+
+	new_last = len(new_tree.nodes) - (len(old_tree.nodes) - old_last)
+	if new_last < first or (new_last < len(new_tree.nodes) and old_tree.nodes[old_last] is not new_tree.nodes[new_last]):
+		old_last = len(old_tree.nodes)
+		new_last = len(new_tree.nodes)
+
+	old_nodes = [n for n in old_tree.nodes[first:old_last] if n.type != 'property']
+	new_nodes = [n for n in new_tree.nodes[first:new_last] if n.type != 'property']
+
+	# positions of rules with the same name depend on preceding rules
+	counter = {}
+	for n in old_tree.nodes[:first]:
+		if n.type != 'property':
+			counter[n.name] = counter.get(n.name, 0) + 1
+
+	# if changed range adds or removes rules, positions of
+	# the following rules with the same names are changed too
+	names = name_counts(old_nodes)
+	for name, count in name_counts(new_nodes).items():
+		if names.get(name) == count:
+			del names[name]
+		else:
+			names[name] = count
+
+	if names:
+		tail = [n for n in old_tree.nodes[old_last:] if n.type != 'property' and n.name in names]
+		old_nodes += tail
+		new_nodes += tail
+
+	return rule_list(old_nodes, counter=dict(counter)), rule_list(new_nodes, counter=counter)
+
+def affected_nodes(tree, start, end):
+	"""
+	Returns `(first, last)` index range of top-level nodes
+	of given tree that intersect `start:end` range
+	"""
+	offsets = tree.offsets
+	first = bisect.bisect_right(offsets, start) - 1
+	if first < 0 or offsets[first] + tree.nodes[first].end < start:
+		first += 1
+
+	return first, bisect.bisect_right(offsets, end)
+
+def name_counts(nodes):
+	out = {}
+	for n in nodes:
+		out[n.name] = out.get(n.name, 0) + 1
+
+	return out
+
+def rule_list(rules, prefix=(), counter=None):
+	"""
+	Returns flat list of `(path, node)` tuples for given
+	rules and all their nested rules
+	"""
+	out = []
+	if counter is None:
+		counter = {}
+
+	for child in rules:
+		pos = counter[child.name] = counter.get(child.name, 0) + 1
+		path = prefix + ((child.name, pos),)
+		out.append((path, child))
+		out += rule_list(child.rules(), path)
+
+	return out
+
+def property_list(node):
+	"Returns list of properties of given rule in patch format"
+	return [{'name': p.name, 'value': p.value, 'index': i} for i, p in enumerate(node.properties())]
+
+def property_map(props):
+	"""
+	Returns dict of given properties, keyed by property name and
+	its occurrence in rule: duplicated properties are widely used as
+	fallbacks for older browsers
+	"""
+	out = {}
+	counter = {}
+	for p in props:
+		pos = counter[p['name']] = counter.get(p['name'], 0) + 1
+		out[(p['name'], pos)] = p
+
+	return out
+
+def diff_properties(old_rule, new_rule):
+	"Returns tuple of updated and removed properties of given rules"
+	return diff_property_lists(property_list(old_rule), property_list(new_rule))
+
+def diff_property_lists(old_props, new_props):
+	"""
+	Returns tuple of updated and removed properties of given
+	property lists in patch format
+	"""
+	old_map = property_map(old_props)
+	new_map = property_map(new_props)
+
+	updated = []
+	for key, p in sorted(new_map.items(), key=lambda item: item[1]['index']):
+		prev = old_map.get(key)
+		if prev is None or prev['value'] != p['value']:
+			updated.append(p)
+
+	removed = [p for key, p in sorted(old_map.items(), key=lambda item: item[1]['index']) if key not in new_map]
+	return updated, removed
+
+def make_patch(path, action, properties=None, removed=None, value=None):
+	patch = {
+		'path': [list(p) for p in path],
+		'action': action
+	}
+
+	if value is not None:
+		patch['value'] = value
+	elif action == 'update':
+		patch['properties'] = properties or []
+		patch['removed'] = removed or []
+
+	return patch
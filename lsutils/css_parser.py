@@ -0,0 +1,358 @@
+"""
+A lightweight CSS parser used by local diff/patch engine.
+Produces a tree of rules (including nested at-rules), block-less
+top-level at-rules like `@import` and properties with source offsets.
+"""
+
+import re
+import bisect
+
+import lsutils.textdiff as textdiff
+
+re_special = re.compile(r'[{};"\'(/]')
+re_space = re.compile(r'\s+')
+re_comment = re.compile(r'/\*.*?\*/', re.S)
+re_comma = re.compile(r'\s*,\s*')
+re_at_name = re.compile(r'@[\w-]*')
+
+class Node(object):
+	"""
+	A single node of parsed CSS tree: a rule, a block-less at-rule
+	(`at-rule` type, its value is everything after at-keyword)
+	or a property
+	"""
+	__slots__ = ('type', 'name', 'value', 'start', 'end',
+		'name_end', 'value_start', 'value_end', 'children')
+
+	def __init__(self, type, name, start, end, name_end=None, value='', value_start=None, value_end=None):
+		self.type = type
+		self.name = name
+		self.value = value
+		self.start = start
+		self.end = end
+		self.name_end = name_end if name_end is not None else end
+		self.value_start = value_start if value_start is not None else self.name_end
+		self.value_end = value_end if value_end is not None else self.value_start
+		self.children = []
+
+	def rules(self):
+		"Returns list of child rules, including block-less at-rules"
+		return [n for n in self.children if n.type != 'property']
+
+	def properties(self):
+		"Returns list of child properties"
+		return [n for n in self.children if n.type == 'property']
+
+	def __repr__(self):
+		return '<%s "%s" %d:%d>' % (self.type, self.name, self.start, self.end)
+
+class Stylesheet(object):
+	"""
+	Parsed stylesheet: a root of CSS tree. Offsets of top-level nodes
+	(and all their children) are relative to the top-level node start,
+	absolute node positions are stored in `offsets` list. This way unchanged
+	nodes are shared between revisions of the same stylesheet and
+	don't have to be updated when preceding content changes.
+	`clean` is `False` if source ends with unterminated node, e.g.
+	unclosed rule, string or comment
+	"""
+	type = 'root'
+	name = ''
+
+	def __init__(self, source, nodes=None, offsets=None, clean=True):
+		self.source = source
+		if nodes is None:
+			nodes, offsets, clean = parse_nodes(source, 0, len(source))
+
+		self.nodes = nodes
+		self.offsets = offsets
+		self.clean = clean
+
+	@property
+	def children(self):
+		return self.nodes
+
+	def rules(self):
+		"Returns list of top-level rules, including block-less at-rules"
+		return [n for n in self.nodes if n.type != 'property']
+
+	def properties(self):
+		"Returns list of top-level properties"
+		return [n for n in self.nodes if n.type == 'property']
+
+	def absolute(self, node):
+		"Returns copy of given top-level node with absolute offsets"
+		return shifted(node, self.offsets[self.nodes.index(node)])
+
+def parse(source):
+	"""
+	Parses given CSS source
+	@type source: str
+	@return: Stylesheet
+	"""
+	return Stylesheet(source)
+
+def update(sheet, source, changed=None):
+	"""
+	Returns stylesheet for updated `source`, re-parsing only top-level
+	nodes affected by change. `changed` is a `(start, old_end, new_end)`
+	tuple of changed range, calculated from sources if omitted
+	@type sheet: Stylesheet
+	@type source: str
+	@return: Stylesheet
+	"""
+	if sheet is None:
+		return Stylesheet(source)
+
+	if changed is None:
+		changed = textdiff.changed_range(sheet.source, source)
+		if changed is None:
+			return sheet
+
+	start, old_end, new_end = changed
+	delta = new_end - old_end
+	nodes, offsets = sheet.nodes, sheet.offsets
+
+	# find top-level nodes touched by change
+	first = bisect.bisect_right(offsets, start) - 1
+	if first < 0 or offsets[first] + nodes[first].end < start:
+		first += 1
+	last = bisect.bisect_right(offsets, old_end) - 1
+
+	# make sure re-parsing starts right after terminated node
+	while first > 0 and sheet.source[offsets[first - 1] + nodes[first - 1].end - 1] not in '};':
+		first -= 1
+
+	if last + 1 >= len(nodes) and not sheet.clean:
+		# unterminated trailing node may swallow any text, including
+		# node terminators, so its bounds can't be trusted
+		return Stylesheet(source)
+
+	region_start = offsets[first - 1] + nodes[first - 1].end if first > 0 else 0
+	if last + 1 < len(nodes):
+		region_end = offsets[last + 1] + delta
+	else:
+		region_end = len(source)
+
+	new_nodes, new_offsets, clean = parse_nodes(source, region_start, region_end)
+	if not clean and region_end != len(source):
+		# change affects structure of the rest of stylesheet
+		last = len(nodes) - 1
+		new_nodes, new_offsets, clean = parse_nodes(source, region_start, len(source))
+	elif region_end != len(source):
+		clean = sheet.clean
+
+	return Stylesheet(source,
+		nodes[:first] + new_nodes + nodes[last + 1:],
+		offsets[:first] + new_offsets + [o + delta for o in offsets[last + 1:]],
+		clean)
+
+def parse_nodes(source, start, end):
+	"""
+	Parses top-level nodes in given source range. Returns tuple of
+	nodes (with relative offsets), their absolute offsets and flag
+	indicating that parsing ended in clean state, e.g. with no
+	unclosed rules or comments
+	"""
+	root, clean = parse_tree(source, start, end)
+	nodes = root.children
+	offsets = []
+	for node in nodes:
+		offsets.append(node.start)
+		shift(node, -node.start)
+
+	return nodes, offsets, clean
+
+def parse_tree(source, start=0, end=None):
+	"""
+	Parses given CSS source range. Returns tuple of root node of
+	parsed tree with absolute offsets and clean state flag
+	@type source: str
+	@return: tuple
+	"""
+	if end is None:
+		end = len(source)
+
+	root = Node('root', '', start, end)
+	stack = [root]
+	pos = seg = start
+	clean = True
+
+	while True:
+		m = re_special.search(source, pos, end)
+		if not m:
+			break
+
+		pos = m.start()
+		ch = source[pos]
+		if ch == '/':
+			pos = skip_comment(source, pos, end)
+		elif ch == '"' or ch == "'":
+			pos = skip_string(source, pos, end)
+		elif ch == '(':
+			pos = skip_parens(source, pos, end)
+		elif ch == '{':
+			s, e = trim(source, seg, pos)
+			node = Node('rule', normalize_selector(source[s:e]), s, pos + 1, name_end=e)
+			stack[-1].children.append(node)
+			stack.append(node)
+			pos = seg = pos + 1
+		elif ch == ';':
+			add_property(stack[-1], source, seg, pos, pos + 1)
+			pos = seg = pos + 1
+		else: # ch == '}'
+			add_property(stack[-1], source, seg, pos, pos)
+			if len(stack) > 1:
+				stack.pop().end = pos + 1
+			pos = seg = pos + 1
+
+		if pos >= end and ch in '/"\'(':
+			# comment, string or parens may be unclosed
+			clean = False
+
+	# unterminated property and rules
+	s, e = trim(source, seg, end)
+	if s != e or len(stack) > 1:
+		clean = False
+
+	add_property(stack[-1], source, seg, end, end)
+	while len(stack) > 1:
+		stack.pop().end = end
+
+	return root, clean
+
+def shift(node, delta):
+	"Shifts offsets of given node and its children by `delta`"
+	node.start += delta
+	node.end += delta
+	node.name_end += delta
+	node.value_start += delta
+	node.value_end += delta
+	for child in node.children:
+		shift(child, delta)
+
+def shifted(node, delta):
+	"Returns deep copy of given node with offsets shifted by `delta`"
+	copy = Node(node.type, node.name, node.start + delta, node.end + delta,
+		name_end=node.name_end + delta, value=node.value,
+		value_start=node.value_start + delta, value_end=node.value_end + delta)
+	copy.children = [shifted(child, delta) for child in node.children]
+	return copy
+
+def add_property(parent, source, start, end, prop_end):
+	"""
+	Parses property from given source range and adds it to `parent`.
+	`end` is the end of property value, `prop_end` is the end
+	of the property itself (including terminating semicolon)
+	"""
+	s, e = trim(source, start, end)
+	if s >= e:
+		return
+
+	if source[s] == '@':
+		# nested at-rules without block are mixin calls
+		# and the like in preprocessors, skip them
+		if parent.type == 'root':
+			add_at_rule(parent, source, s, e, prop_end if prop_end > end else e)
+		return
+
+	colon = source.find(':', s, e)
+	if colon == -1:
+		# not a property, e.g. @import or mixin call
+		return
+
+	name_start, name_end = trim(source, s, colon)
+	if name_start == name_end:
+		return
+
+	value_start, value_end = trim(source, colon + 1, e)
+	value_start = min(value_start, value_end)
+	parent.children.append(Node('property', source[name_start:name_end], s, prop_end if prop_end > end else e,
+		name_end=name_end, value=source[value_start:value_end],
+		value_start=value_start, value_end=value_end))
+
+def add_at_rule(parent, source, start, end, rule_end):
+	"""
+	Adds block-less at-rule, e.g. `@import` or `@charset`, from given
+	trimmed source range to `parent`
+	"""
+	name_end = re_at_name.match(source, start, end).end()
+	value_start, value_end = trim(source, name_end, end)
+	value_start = min(value_start, value_end)
+	parent.children.append(Node('at-rule', source[start:name_end], start, rule_end,
+		name_end=name_end, value=source[value_start:value_end],
+		value_start=value_start, value_end=value_end))
+
+def trim(source, start, end):
+	"Returns range of given source fragment without surrounding whitespace and comments"
+	while start < end:
+		ch = source[start]
+		if ch.isspace():
+			start += 1
+		elif source.startswith('/*', start, end):
+			start = min(skip_comment(source, start, end), end)
+		else:
+			break
+
+	while end > start:
+		ch = source[end - 1]
+		if ch.isspace():
+			end -= 1
+		elif end - start >= 4 and source.startswith('*/', end - 2, end):
+			ix = source.rfind('/*', start, end - 2)
+			if ix == -1:
+				break
+			end = ix
+		else:
+			break
+
+	return start, end
+
+def skip_comment(source, pos, end):
+	"Skips comment at given position, returns position right after comment"
+	if not source.startswith('/*', pos, end):
+		return pos + 1
+
+	ix = source.find('*/', pos + 2, end)
+	return end if ix == -1 else ix + 2
+
+def skip_string(source, pos, end):
+	"Skips quoted string at given position"
+	quote = source[pos]
+	pos += 1
+	while pos < end:
+		ch = source[pos]
+		if ch == '\\':
+			pos += 2
+		elif ch == quote or ch == '\n':
+			return pos + 1
+		else:
+			pos += 1
+
+	return end
+
+def skip_parens(source, pos, end):
+	"Skips parenthesized expression, e.g. url(...), at given position"
+	depth = 0
+	while pos < end:
+		ch = source[pos]
+		if ch == '(':
+			depth += 1
+		elif ch == ')':
+			depth -= 1
+			if not depth:
+				return pos + 1
+		elif ch == '"' or ch == "'":
+			pos = skip_string(source, pos, end)
+			continue
+		elif ch == '{' or ch == '}':
+			# unbalanced parens, stop here to keep structure of the rest of the file
+			return pos
+		pos += 1
+
+	return end
+
+def normalize_selector(sel):
+	"Normalizes given selector for comparison"
+	sel = re_space.sub(' ', re_comment.sub('', sel)).strip()
+	return re_comma.sub(', ', sel)
@@ -0,0 +1,617 @@
+"""
+Applies LiveStyle patches (see `css_diff` for format description)
+on CSS source and produces a list of minimal text edits instead of
+the whole patched source.
+
+Each edit is a `[start, end, text]` list. Edits must be applied
+in the same order as they appear in list: each edit is relative
+to the source with all previous edits applied.
+"""
+
+import re
+import itertools
+
+import lsutils.css_parser as css_parser
+import lsutils.css_diff as css_diff
+
+re_indent = re.compile(r'[ \t]*')
+
+def patch(source, patches, tree=None):
+	"""
+	Applies given patches on CSS source.
+	Returns tuple of edits list and parsed patched stylesheet
+	@type source: str
+	@type patches: list
+	@type tree: css_parser.Stylesheet
+	"""
+	if tree is None or tree.source != source:
+		tree = css_parser.update(tree, source)
+
+	edits = []
+	for p in patches:
+		patch_edits = patch_edits_for(source, tree, p)
+		if patch_edits:
+			source = apply_edits(source, patch_edits)
+			tree = css_parser.update(tree, source, changed_range(patch_edits))
+			edits += patch_edits
+
+	return edits, tree
+
+def patch_edits_for(source, tree, p):
+	"Returns list of edits required to apply single patch on parsed source"
+	path = [tuple(item) for item in p.get('path', [])]
+	if not path:
+		return []
+
+	parent, node, missing = locate(tree, path)
+	if p.get('action') == 'remove':
+		if node is None:
+			return []
+		return [[whitespace_before(source, node.start), node.end, '']]
+
+	if 'value' in p:
+		return at_rule_edits(source, tree, node, path, p)
+
+	if node is None:
+		# rule doesn't exists, create it with all properties
+		return [create_rule(source, parent, missing, p.get('properties', []))]
+
+	edits = []
+	removed = find_removed(node.properties(), p.get('removed', []))
+	for r in removed:
+		edits.append([whitespace_before(source, r.start), r.end, ''])
+
+	props = [x for x in node.properties() if x not in removed]
+	for prop, existing in match_properties(props, p.get('properties', []), p.get('removed')):
+		if existing is not None:
+			if existing.value != prop['value']:
+				edits.append([existing.value_start, existing.value_end, prop['value']])
+		else:
+			edits.append(insert_property(source, node, props, prop))
+
+	# apply edits from the end of document so they won't affect each other,
+	# edits at the same position are applied in reverse order to keep
+	# inserted properties in original order
+	order = sorted(range(len(edits)), key=lambda i: (edits[i][0], edits[i][1], i), reverse=True)
+	return [edits[i] for i in order]
+
+def locate(tree, path):
+	"""
+	Locates rule for given path in tree. Returns tuple of
+	nearest existing parent, matched node (or `None`) and list of
+	missing path items
+	"""
+	parent = tree
+	for i, (name, pos) in enumerate(path):
+		matches = [r for r in parent.rules() if r.name == name]
+		if not matches:
+			return parent, None, path[i:]
+
+		node = matches[min(pos, len(matches)) - 1]
+		if parent is tree:
+			node = tree.absolute(node)
+		if i == len(path) - 1:
+			return parent, node, []
+		parent = node
+
+	return parent, None, []
+
+def find_property(rule, name, value=None, index=None, props=None):
+	"Finds best matching property with given name in rule"
+	if props is None:
+		props = rule.properties()
+
+	matches = [p for p in props if p.name == name]
+	if not matches:
+		return None
+
+	if value is not None:
+		for p in matches:
+			if p.value == value:
+				return p
+
+	if index is not None and index < len(props) and props[index].name == name:
+		return props[index]
+
+	return matches[-1]
+
+def match_properties(props, updated, removed=None):
+	"""
+	Matches updated properties of patch with existing `props` of rule.
+	Returns list of `(prop, existing)` tuples, where `existing` is `None`
+	for inserted property. Indexes in patch are positions in updated rule,
+	so returned properties have indexes shifted by preceding insertions.
+
+	Like in `css_diff`, duplicated properties are identified by their
+	occurrence in rule: property is updated only if its value is changed,
+	declarations are never matched twice and new occurrences of the same
+	name are inserted after the existing ones. Rule with removed occurrences
+	of property doesn't get new ones
+	"""
+	no_index = len(props) + len(updated)
+	updated = sorted(updated, key=lambda p: p.get('index', no_index))
+	removed_names = set(r['name'] for r in removed or [])
+	matches = None
+	if all(p.get('index') is not None for p in updated):
+		matches = _match_by_occurrence(props, updated, removed_names)
+	if matches is None:
+		matches = _match_by_position(props, updated)
+
+	out = []
+	inserted = 0
+	for prop, existing in zip(updated, matches):
+		if prop.get('index') is not None:
+			prop = dict(prop, index=max(0, prop['index'] - inserted))
+		if existing is None:
+			inserted += 1
+		out.append((prop, existing))
+
+	return out
+
+def _occurrences(props):
+	"Returns list of occurrence numbers of given properties names"
+	counter = {}
+	out = []
+	for p in props:
+		counter[p.name] = counter.get(p.name, 0) + 1
+		out.append(counter[p.name])
+
+	return out
+
+def _match_by_occurrence(props, updated, removed_names, max_variants=256):
+	"""
+	Matches properties by reconstructing layout of updated rule: patch
+	properties take their positions, unchanged properties fill the rest in
+	original order. Each variant of inserted properties count and updated
+	occurrences is checked for consistency with occurrences of names,
+	the one with fewest insertions that reorders existing properties least
+	wins; on a tie, updates of later occurrences are preferred since
+	insertion shifts occurrences that follow it. Returns list of matched
+	properties or `None`
+	"""
+	names = []
+	for p in updated:
+		if p['name'] not in names:
+			names.append(p['name'])
+
+	occ = _occurrences(props)
+	total = dict((n, len([x for x in props if x.name == n])) for n in names)
+	count = dict((n, len([p for p in updated if p['name'] == n])) for n in names)
+
+	options = []
+	for n in names:
+		lo = max(0, count[n] - total[n])
+		hi = 0 if n in removed_names else count[n]
+		variants = [(n, ins, keys) for ins in range(lo, hi + 1)
+			for keys in itertools.combinations(range(1, total[n] + 1), count[n] - ins)]
+		if not variants:
+			return None
+		options.append(variants)
+
+	size = 1
+	for o in options:
+		size *= len(o)
+	if size > max_variants:
+		return None
+
+	best = None
+	for variant in itertools.product(*options):
+		inserts = dict((n, ins) for n, ins, _ in variant)
+		keys = dict((n, k) for n, _, k in variant)
+		result = _layout_matches(props, occ, updated, inserts, keys, total)
+		if result is not None and (best is None or result[1] < best[1]):
+			best = result
+
+	return best and best[0]
+
+def _layout_matches(props, occ, updated, inserts, keys, total):
+	"""
+	Returns matched properties for layout of updated rule where the last
+	`inserts[name]` patch properties of each name are inserted and the
+	rest update `keys[name]` occurrences, and cost of this layout, or `None`
+	if such layout is inconsistent
+	"""
+	size = len(props) + sum(inserts.values())
+	if any(p['index'] >= size for p in updated):
+		return None
+
+	# patch property -> updated occurrence, `None` for inserted one
+	targets = []
+	seen = {}
+	for p in updated:
+		name = p['name']
+		i = seen[name] = seen.get(name, 0) + 1
+		targets.append(keys[name][i - 1] if i <= len(keys[name]) else None)
+
+	unchanged = [(x, k) for x, k in zip(props, occ) if k not in keys.get(x.name, ())]
+	layout = [None] * size
+	for i, p in enumerate(updated):
+		if layout[p['index']] is not None:
+			return None
+		layout[p['index']] = ('patch', i)
+
+	free = [ix for ix, item in enumerate(layout) if item is None]
+	if len(free) != len(unchanged):
+		return None
+	for ix, item in zip(free, unchanged):
+		layout[ix] = ('prop', item)
+
+	counter = {}
+	positions = {}
+	for ix, (kind, item) in enumerate(layout):
+		name = updated[item]['name'] if kind == 'patch' else item[0].name
+		rank = counter[name] = counter.get(name, 0) + 1
+		if kind == 'prop':
+			if rank != item[1]:
+				return None
+			positions[(name, rank)] = ix
+		elif targets[item] is None:
+			if rank <= total[name]:
+				return None
+		elif rank != targets[item]:
+			return None
+		else:
+			positions[(name, rank)] = ix
+
+	out = []
+	for p, k in zip(updated, targets):
+		if k is None:
+			out.append(None)
+			continue
+		existing = [x for x, o in zip(props, occ) if x.name == p['name'] and o == k][0]
+		if existing.value == p['value']:
+			return None
+		out.append(existing)
+
+	# existing properties that change their relative order
+	order = sorted(range(len(props)), key=lambda ix: positions[(props[ix].name, occ[ix])])
+	moved = len([1 for i in range(len(order)) for j in range(i + 1, len(order)) if order[i] > order[j]])
+	shifted = -sum(props.index(x) for x in out if x is not None)
+	return out, (sum(inserts.values()), moved, shifted)
+
+def _match_by_position(props, updated):
+	"""
+	Matches properties by their positions: fallback for patches
+	without indexes or with inconsistent ones. Property is matched
+	with unmatched declaration of the same name at its index, otherwise
+	with one having the same value (update is a no-op then) or the last
+	one. Property is inserted only if there's no unmatched declaration
+	of its name left
+	"""
+	out = []
+	inserted = 0
+	# ids of matched declarations
+	matched = set()
+	for prop in updated:
+		name = prop['name']
+		index = prop.get('index')
+		candidates = [x for x in props if x.name == name and id(x) not in matched]
+		existing = None
+		if index is not None:
+			index = max(0, index - inserted)
+			if index < len(props) and props[index] in candidates:
+				existing = props[index]
+		if existing is None and candidates:
+			existing = find_property(None, name, prop.get('value'), props=candidates)
+
+		if existing is None:
+			inserted += 1
+		else:
+			matched.add(id(existing))
+		out.append(existing)
+
+	return out
+
+def find_removed(props, removed):
+	"Returns list of properties matching removed ones"
+	out = []
+	for r in removed:
+		# the same property can't be removed twice
+		prop = find_property(None, r['name'], r.get('value'), props=[x for x in props if x not in out])
+		if prop is not None:
+			out.append(prop)
+
+	return out
+
+def insert_property(source, rule, props, prop):
+	"Returns edit that inserts new property into given rule"
+	decl = '%s: %s;' % (prop['name'], prop['value'])
+	index = prop.get('index')
+	if index is None or index > len(props):
+		index = len(props)
+
+	if not props:
+		body_start = source.find('{', rule.name_end, rule.end) + 1
+		body = source[body_start:rule.end - 1]
+		if '\n' in body:
+			return [body_start, body_start, '\n%s%s' % (indentation(source, rule.start) + '\t', decl)]
+		return [body_start, body_start, ' %s ' % decl if not body.strip() else ' %s' % decl]
+
+	if index:
+		ref = props[index - 1]
+		pos = ref.end
+		prefix = ';' if source[ref.end - 1] != ';' else ''
+	else:
+		ref = props[0]
+		pos = whitespace_before(source, ref.start)
+		prefix = ''
+
+	if '\n' in source[rule.name_end:ref.start]:
+		sep = '\n' + indentation(source, ref.start)
+	else:
+		sep = ' '
+
+	return [pos, pos, prefix + sep + decl]
+
+def create_rule(source, parent, path, props):
+	"Returns edit that creates nested rules for given path in parent node"
+	level = 0 if parent.type == 'root' else indentation(source, parent.start).count('\t') + 1
+	text = ''.join('\n%s%s: %s;' % ('\t' * (level + len(path)), p['name'], p['value']) for p in props)
+	for i in range(len(path) - 1, -1, -1):
+		indent = '\t' * (level + i)
+		text = '\n%s%s {%s\n%s}' % (indent, path[i][0], text, indent)
+
+	if parent.type == 'root':
+		pos = len(source.rstrip())
+		return [pos, pos, '\n' + text if pos else text.lstrip()]
+
+	pos = parent.end - 1 if source[parent.end - 1] == '}' else parent.end
+	pos = whitespace_before(source, pos)
+	return [pos, pos, text]
+
+def at_rule_edits(source, tree, node, path, p):
+	"""
+	Returns edits that add or update top-level block-less at-rule,
+	like `@import`, with value from given patch
+	"""
+	if len(path) != 1 or not p['value']:
+		return []
+
+	if p.get('action') != 'add' and node is not None and node.type == 'at-rule':
+		if node.value == p['value']:
+			return []
+		return [[node.value_start, node.value_end, p['value']]]
+
+	# new at-rule goes right after its previous occurrence or before the
+	# next one, otherwise, like in browser, `@charset` goes first, `@import`
+	# after leading `@charset` and `@import` rules and the rest to the end
+	name, rank = path[0]
+	nodes = tree.nodes
+	text = '%s %s;' % (name, p['value'])
+	same = [i for i, n in enumerate(nodes) if n.type == 'at-rule' and n.name == name]
+	if same and rank > 1:
+		ix = same[min(rank - 1, len(same)) - 1] + 1
+	elif same:
+		pos = tree.offsets[same[0]]
+		return [[pos, pos, text + '\n']]
+	elif name.lower() == '@charset':
+		ix = 0
+	elif name.lower() == '@import':
+		ix = 0
+		while ix < len(nodes) and nodes[ix].name.lower() in ('@charset', '@import'):
+			ix += 1
+	else:
+		ix = len(nodes)
+
+	if ix:
+		pos = tree.offsets[ix - 1] + nodes[ix - 1].end
+		return [[pos, pos, '\n' + text]]
+
+	if nodes:
+		return [[tree.offsets[0], tree.offsets[0], text + '\n']]
+
+	pos = len(source.rstrip())
+	return [[pos, pos, '\n' + text if pos else text]]
+
+def compact(patches, tree=None):
+	"""
+	Merges patches of the same rule into a single patch, so a burst of
+	updates is applied at once: the latest value of each property wins,
+	property added and then removed is dropped.
+
+	If `tree` with source the patches will be applied to is given, patches
+	are replayed on property lists of its rules and merged patch is used
+	only if it produces the same properties in the same order, so result
+	is exactly the same as of patches applied one by one. Contents of rules
+	are unknown after `remove` patch or patch with ambiguous path, the
+	following patches are kept as is.
+
+	Otherwise, only patches that update the same set of properties are
+	merged, which is enough for browser patcher that updates properties
+	by name. `remove` patches change positions of the following sibling
+	rules, so patches are never merged or reordered across them
+	@type tree: css_parser.Stylesheet
+	"""
+	exact = tree is not None
+	out = []
+	# merged patches of current segment, in order of first appearance
+	segment = []
+	# path -> index of merged patch in segment
+	merged = {}
+	# path -> (original, patched) property lists of rule
+	replayed = {}
+	# path -> replayed patches
+	originals = {}
+
+	def flush():
+		for p in segment:
+			path = tuple(tuple(item) for item in p['path'])
+			if path in replayed:
+				original, patched = replayed[path]
+				p = _replayed_patch(p, original, patched)
+				if not _same_properties(_replay(original, p) if p else original, patched):
+					# patcher reads merged patch differently, e.g. puts
+					# properties in another order: keep patches as is
+					out.extend(originals[path])
+					continue
+			if p is not None:
+				out.append(p)
+		del segment[:]
+		merged.clear()
+		replayed.clear()
+		originals.clear()
+
+	for p in patches:
+		if 'value' in p or (exact and tree is None):
+			# block-less at-rules have no properties to merge and
+			# adding them doesn't change positions of other rules
+			out.append(p)
+			continue
+
+		path = tuple(tuple(item) for item in p.get('path', []))
+		if p.get('action') == 'remove' or (tree is not None and _is_ambiguous(tree, path)):
+			flush()
+			out.append(p)
+			# the following patches are applied on modified tree
+			tree = None
+			continue
+
+		ix = merged.get(path)
+		if ix is None:
+			merged[path] = len(segment)
+			segment.append(p)
+			if tree is not None:
+				node = locate(tree, path)[1]
+				props = [_Property(x.name, x.value) for x in node.properties()] if node else None
+				replayed[path] = (props, _replay(props, p))
+				originals[path] = [p]
+		elif path in replayed:
+			segment[ix] = p
+			replayed[path] = (replayed[path][0], _replay(replayed[path][1], p))
+			originals[path].append(p)
+		else:
+			update = _merge_updates(segment[ix], p)
+			if update is None:
+				flush()
+				merged[path] = 0
+				segment.append(p)
+			else:
+				segment[ix] = update
+
+	flush()
+	return out
+
+class _Property(object):
+	"Property name and value, used to replay patches on property lists"
+	__slots__ = ('name', 'value')
+
+	def __init__(self, name, value):
+		self.name = name
+		self.value = value
+
+def _replay(props, p):
+	"""
+	Returns property list with given update patch applied, the same
+	way `patch_edits_for` applies it on rule. `props` is `None` if
+	rule doesn't exist yet
+	"""
+	if props is None:
+		return [_Property(x['name'], x['value']) for x in p.get('properties', [])]
+
+	removed = find_removed(props, p.get('removed', []))
+	props = [_Property(x.name, x.value) for x in props if x not in removed]
+	inserted = []
+	for i, (prop, existing) in enumerate(match_properties(props, p.get('properties', []), p.get('removed'))):
+		if existing is not None:
+			existing.value = prop['value']
+		else:
+			index = prop.get('index')
+			if index is None or index > len(props):
+				index = len(props)
+			inserted.append((index, i, _Property(prop['name'], prop['value'])))
+
+	# all insertions are relative to original list
+	for index, i, prop in sorted(inserted, key=lambda item: (item[0], item[1]), reverse=True):
+		props.insert(index, prop)
+
+	return props
+
+def _same_properties(props1, props2):
+	"Check if given property lists have the same names and values in the same order"
+	if props1 is None or props2 is None:
+		return props1 is props2
+	return [(x.name, x.value) for x in props1] == [(x.name, x.value) for x in props2]
+
+def _replayed_patch(p, original, patched):
+	"Returns patch that turns `original` property list into `patched` one"
+	as_dict = lambda props: [{'name': x.name, 'value': x.value, 'index': i} for i, x in enumerate(props)]
+	if original is None:
+		updated, removed = as_dict(patched), []
+	else:
+		updated, removed = css_diff.diff_property_lists(as_dict(original), as_dict(patched))
+		if not updated and not removed:
+			return None
+
+	return dict(p, action='update', properties=updated, removed=removed)
+
+def _is_ambiguous(tree, path):
+	"""
+	Check if given path points to rule position that doesn't exist
+	in tree, while rules with the same name exist: `locate` resolves
+	such path to another rule. The same goes for missing rule that isn't
+	the first one with its name, once preceding rule is created
+	"""
+	parent = tree
+	for i, (name, pos) in enumerate(path):
+		matches = [r for r in parent.rules() if r.name == name]
+		if not matches:
+			return any(item[1] > 1 for item in path[i:])
+		if pos > len(matches):
+			return True
+		parent = matches[pos - 1]
+
+	return False
+
+def _merge_updates(prev, cur):
+	"""
+	Returns single patch with the same effect as two update patches
+	of the same rule, or `None` if it can't be guaranteed without
+	knowing rule contents
+	"""
+	keys = lambda p: [(x['name'], x.get('index')) for x in p.get('properties', [])]
+	if prev.get('removed') or cur.get('removed') or sorted(keys(prev)) != sorted(keys(cur)):
+		return None
+
+	names = [name for name, index in keys(cur)]
+	if len(names) != len(set(names)):
+		# duplicated properties are matched by position
+		return None
+
+	return cur
+
+def indentation(source, pos):
+	"Returns indentation of line containing given position"
+	line_start = source.rfind('\n', 0, pos) + 1
+	return re_indent.match(source, line_start).group(0)
+
+def whitespace_before(source, pos):
+	"""
+	Returns position of whitespace preceding given position,
+	including a single line break
+	"""
+	while pos > 0 and source[pos - 1] in ' \t':
+		pos -= 1
+
+	if pos > 0 and source[pos - 1] == '\n':
+		pos -= 1
+		if pos > 0 and source[pos - 1] == '\r':
+			pos -= 1
+
+	return pos
+
+def changed_range(edits):
+	"""
+	Returns `(start, old_end, new_end)` range affected by edits
+	sorted from the end of document
+	"""
+	start = min(e[0] for e in edits)
+	end = max(e[1] for e in edits)
+	delta = sum(len(text) - (e - s) for s, e, text in edits)
+	return start, end, end + delta
+
+def apply_edits(source, edits):
+	"Applies given edits list on source"
+	for start, end, text in edits:
+		source = source[:start] + text + source[end:]
+
+	return source
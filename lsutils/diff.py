@@ -9,19 +9,47 @@ import time
 import json
 import logging
 import imp
+import itertools
 
 import lsutils.editor as eutils
 import lsutils.websockets as ws
+import lsutils.css_parser as css_parser
+import lsutils.css_diff as css_diff
+import lsutils.css_patch as css_patch
+import lsutils.css_cache as css_cache
+import lsutils.textdiff as textdiff
+import lsutils.snapshots as snapshots
+import lsutils.stats as stats
+import lsutils.wire as wire
+from lsutils.scheduler import Scheduler
 
 from lsutils.event_dispatcher import EventDispatcher
 
-LOCK_TIMEOUT = 15 # State lock timeout, in seconds
-
 logger = logging.getLogger('livestyle')
 _diff_state = {}
 _patch_state = {}
 _dispatcher = EventDispatcher()
 
+# Content snapshots of diff'ed buffers
+_snapshots = snapshots.SnapshotStore(on_evict=lambda buf_id: release(buf_id))
+
+# Parse trees are much larger, they're kept for a few recently used buffers only
+css_cache.on_evict(lambda buf_id: drop_sheet(buf_id))
+
+# Coalesces diff requests produced by fast typing
+_scheduler = Scheduler()
+
+# Number of unanswered requests of a buffer in a row after which
+# it isn't sent again. Each retry waits twice longer for response
+MAX_RETRIES = 3
+
+# Identifiers of diff and patch requests
+_request_ids = itertools.count(1)
+
+# Hashes of the last source of each buffer received by clients
+# that support `sourceHash`: client -> {buf_id: hash}
+_client_sources = {}
+
 def on(name, callback):
 	_dispatcher.on(name, callback)
 
@@ -34,20 +62,243 @@ def one(name, callback):
 def get_syntax(view):
 	return view.score_selector(0, 'source.less, source.scss') and 'scss' or 'css'
 
-def lock_state(state):
-	state['running'] = True
-	state['start_time'] = time.time()
+def use_local_engine(syntax):
+	"Check if local diff/patch engine should be used for given syntax"
+	# preprocessors are resolved by browser client only
+	return syntax == 'css' and eutils.get_setting('diff_engine', 'local') == 'local'
+
+def pipeline_depth():
+	"Returns maximum number of diff requests of a buffer in flight"
+	return max(1, int(eutils.get_setting('max_pipelined_diffs', 4)))
+
+def request_timeout(retries=0):
+	"""
+	Returns time to wait for response to diff or patch request,
+	in milliseconds, after given number of unanswered requests
+	"""
+	return max(1, int(eutils.get_setting('request_timeout', 5000))) * 2 ** min(retries, MAX_RETRIES)
+
+def next_request_id():
+	return next(_request_ids)
+
+def add_request(kind, buf_id, state, rid, client, **kw):
+	"""
+	Registers request of given state sent to client. Besides `rid`
+	identifier, each request has `seq`: sequence number of request
+	among requests of the same buffer. If there's no response
+	in `request_timeout()`, request is sent to another client
+	"""
+	state['seq'] += 1
+	req = dict(kw, id=rid, seq=state['seq'], client=None, start_time=time.time(),
+		timeout=request_timeout(state['retries']))
+	assign_client(req, client)
+	state['requests'].append(req)
+	sublime.set_timeout(lambda: _on_request_timeout(kind, buf_id, rid), req['timeout'])
+	return req
+
+def can_request(kind, buf_id, state, depth=1):
+	"""
+	Check if new request of given state can be sent. Clients that
+	support `requestId` accept up to `depth` pipelined requests
+	"""
+	reqs = state['requests']
+	if not reqs:
+		return True
+
+	return len(reqs) < depth and ws.supports(reqs[-1]['client'], 'requestId')
+
+def drop_requests(kind, buf_id, state, timed_out=False):
+	"""
+	Drops requests of given state in flight: responses to them are
+	discarded and clients that support `requestId` are asked to cancel
+	them. Timed out requests count as slow responses of their clients
+	"""
+	cancelled = {}
+	now = time.time()
+	for req in state['requests']:
+		client = req['client']
+		if client is not None and client in ws.clients() and ws.supports(client, 'requestId'):
+			cancelled.setdefault(client, []).append(req['id'])
+
+		release_client(req, now - req['start_time'] if timed_out else None)
+		stats.cancel(kind, buf_id, req['id'])
+
+	state['requests'] = []
+	for client, ids in cancelled.items():
+		ws.send({
+			'action': 'cancel',
+			'data': {
+				'file': buf_id,
+				'requestIds': ids
+			}
+		}, client)
+
+def take_request(kind, buf_id, state, data, sender):
+	"""
+	Removes request answered by given response from requests in flight
+	and returns it, or returns `None` if response is stale. Clients answer
+	requests in order, so requests sent before the answered one are lost:
+	answered request is marked with `lost` key then
+	"""
+	if state is None:
+		return None
 
-def unlock_state(state, log_message=None):
-	state['running'] = False
-	if log_message:
-		logger.debug(log_message % (time.time() - state['start_time'], ))
+	reqs = state['requests']
+	rid = data.get('requestId')
+	ix = -1
+	for i, r in enumerate(reqs):
+		if r['client'] is sender and (rid is None or r['id'] == rid):
+			ix = i
+			break
 
-def is_locked(state):
-	if state['running']:
-		return time.time() - state['start_time'] < LOCK_TIMEOUT
+	if ix == -1 or (rid is None and ix):
+		return None
+
+	req = reqs[ix]
+	if ix:
+		logger.debug('Lost responses to %d %s requests' % (ix, kind))
+		for r in reqs[:ix]:
+			release_client(r)
+			stats.cancel(kind, buf_id, r['id'])
+		req['lost'] = True
+
+	del reqs[:ix + 1]
+	release_client(req, time.time() - req['start_time'])
+	state['retries'] = 0
+	return req
+
+def _on_request_timeout(kind, buf_id, rid):
+	"""
+	Fails over request that wasn't answered in time, along with the
+	requests pipelined after it, to another client or local engine.
+	Gives up after `MAX_RETRIES` unanswered requests in a row
+	"""
+	state = (_diff_state if kind == 'diff' else _patch_state).get(buf_id)
+	if state is None:
+		return
+
+	reqs = state['requests']
+	timed_out = [r for r in reqs if r['id'] == rid]
+	if not timed_out:
+		# request is already answered or dropped
+		return
+
+	client = timed_out[0]['client']
+	drop_requests(kind, buf_id, state, timed_out=True)
+	state['retries'] += 1
+	if state['retries'] > MAX_RETRIES:
+		logger.error('No response to %d %s requests in a row, give up' % (state['retries'], kind))
+		if kind == 'patch':
+			state['patches'] = []
+		return
+
+	logger.warn('No response to %s request in %d ms, fail over' % (kind, timed_out[0]['timeout']))
+	if kind == 'diff':
+		_start_diff(buf_id, exclude=client)
+	else:
+		patches = sum([r['sent'] for r in reqs], []) + state['patches']
+		state['patches'] = []
+		if patches:
+			_start_patch(buf_id, patches, exclude=client)
+
+def fallback_client(exclude=None):
+	"""
+	Returns the least loaded client except `exclude` one. If there's
+	no other client, request is retried with `exclude` client
+	"""
+	client = ws.pick_client({'supports': 'css'}, exclude=exclude)
+	if client is None and exclude in ws.clients():
+		client = exclude
+
+	return client
+
+def use_local_fallback(syntax, exclude):
+	"""
+	Check if request failed with `exclude` client should be handled
+	by local engine: there's no other client for it
+	"""
+	return syntax == 'css' and exclude is not None and ws.pick_client({'supports': 'css'}, exclude=exclude) is None
+
+def assign_client(req, client):
+	"Marks request as waiting for response from given client"
+	release_client(req)
+	req['client'] = client
+	ws.request_started(client)
+
+def release_client(req, response_time=None):
+	"Releases client that request is waiting for response from"
+	client = req.get('client')
+	if client is not None:
+		req['client'] = None
+		ws.request_finished(client, response_time)
+
+def add_source(data, key, client, buf_id, content, chash=None, hint=None, base=None):
+	"""
+	Adds `key` source of given buffer to request data. If client
+	already has the same source, only its hash is sent as `keyHash`.
+	If client has `base` source, clients that support `sourceDelta`
+	receive `keyDelta` with edits of the base. `base` is a `(hash, content)`
+	tuple, snapshot of buffer by default. Both `content` and base content
+	may be functions that return source: they're called only if source
+	has to be sent. `hint` is a region of content expected to contain
+	changes since base. Returns hash of source, if it's known
+	"""
+	if base is None:
+		base = (_snapshots.hash(buf_id), lambda: _snapshots.get(buf_id, ''))
+
+	if ws.supports(client, 'sourceHash'):
+		if chash is None:
+			content = content() if callable(content) else content
+			chash = snapshots.content_hash(content)
+
+		known = _client_sources.setdefault(client, {})
+		base_hash = known.get(buf_id)
+		if base_hash == chash:
+			data[key + 'Hash'] = chash
+			return chash
+
+		known[buf_id] = chash
+		if base_hash and ws.supports(client, 'sourceDelta') and base_hash == base[0]:
+			content = content() if callable(content) else content
+			delta = make_delta(base[1]() if callable(base[1]) else base[1], content, hint)
+			if delta is not None:
+				delta['base'] = base_hash
+				delta['hash'] = chash
+				data[key + 'Delta'] = delta
+				return chash
+
+	data[key] = content() if callable(content) else content
+	return chash
+
+def make_delta(base, content, hint=None):
+	"""
+	Returns delta that transforms `base` into `content` as
+	`{edits: [[start, end, text]]}` dict or `None` if delta
+	isn't smaller than content itself
+	"""
+	changed = textdiff.changed_range(base, content, hint)
+	if changed is None:
+		edits = []
+	else:
+		start, base_end, end = changed
+		if end - start >= len(content) // 2:
+			return None
+		edits = [[start, base_end, content[start:end]]]
+
+	return {'edits': edits}
+
+def forget_sources(client=None, buf_id=None):
+	"""
+	Forgets sources received by given client or sources
+	of given buffer received by any client
+	"""
+	if buf_id is None:
+		_client_sources.pop(client, None)
+		return
 
-	return False
+	clients = [client] if client is not None else list(_client_sources.keys())
+	for c in clients:
+		_client_sources.get(c, {}).pop(buf_id, None)
 
 ###############################
 # Diff
@@ -59,17 +310,76 @@ def prepare_diff(buf_id):
 	if view is None:
 		return
 
+	# perform pending diff before taking new snapshot
+	_scheduler.flush(buf_id)
+
 	if buf_id not in _diff_state:
 		_diff_state[buf_id] = {
-			'running': False, 
 			'required': False, 
-			'content': '', 
-			'start_time': 0
+			'sheet': None,
+			'change_count': 0,
+			'size': 0,
+			'dirty': None,
+			'requests': [],
+			'seq': 0,
+			'retries': 0
 		}
 
-	_diff_state[buf_id]['content'] = eutils.content(view)
+	state = _diff_state[buf_id]
+	content = eutils.content(view)
+	if use_local_engine(get_syntax(view)):
+		state['sheet'] = css_cache.get(buf_id, content)
+	else:
+		state['sheet'] = None
+
+	_snapshots.limit = int(eutils.get_setting('snapshot_limit', 30))
+	_snapshots.put(buf_id, content)
+	css_cache.limit = int(eutils.get_setting('stylesheet_cache_limit', 3))
+	state['change_count'] = view.change_count()
+	state['size'] = view.size()
+	state['dirty'] = None
+
+def mark_modified(buf_id, view):
+	"""
+	Records modified region of given view: region around selections
+	since the last diff. It's used as a hint for finding changed range
+	"""
+	state = _diff_state.get(buf_id)
+	if state is None:
+		return
+
+	sels = view.sel()
+	if not len(sels):
+		return
+
+	lo = view.line(min(r.begin() for r in sels)).begin()
+	hi = view.line(max(r.end() for r in sels)).end()
+	size = view.size()
+
+	if state['dirty']:
+		# previous region may be shifted by current modification
+		lo = min(lo, state['dirty'][0])
+		hi = max(hi, state['dirty'][1] + max(size - state['size'], 0))
+
+	state['dirty'] = (lo, min(hi, size))
+	state['size'] = size
 
 def diff(buf_id):
+	"""
+	Schedules diff'ing of given buffer: bursts of modifications
+	are coalesced into a single diff
+	"""
+	_scheduler.debounce = int(eutils.get_setting('diff_debounce', 100))
+	_scheduler.max_latency = int(eutils.get_setting('diff_max_latency', 500))
+	_scheduler.schedule(buf_id, lambda: _diff(buf_id))
+
+def queue_depth():
+	"Returns number of buffers waiting for diff"
+	return _scheduler.depth()
+
+stats.gauge('diff_queue_depth', queue_depth)
+
+def _diff(buf_id):
 	"""
 	Performs diff'ing of two states of the same file
 	in separate thread
@@ -79,51 +389,134 @@ def diff(buf_id):
 		prepare_diff(buf_id)
 
 	state = _diff_state[buf_id]
-	if is_locked(state):
+	if not can_request('diff', buf_id, state, pipeline_depth()):
 		state['required'] = True
 	else:
 		_start_diff(buf_id)
 
-def _start_diff(buf_id):
+def _start_diff(buf_id, exclude=None):
 	view = eutils.view_for_buffer_id(buf_id)
 	if view is None:
 		return
 
 	state = _diff_state[buf_id]
-	prev_content = state['content']
-	content = eutils.content(view)
-	syntax = get_syntax(view)
-
 	state['required'] = False
+	reqs = state['requests']
 
-	client = ws.find_client({'supports': 'css'})
+	change_count = view.change_count()
+	if change_count == (reqs[-1]['change_count'] if reqs else state['change_count']):
+		logger.debug('No changes since last diff')
+		return
+
+	rid = next_request_id()
+	timer = stats.start('diff', buf_id, eutils.file_name(view), rid)
+	content = eutils.content(view)
+	syntax = get_syntax(view)
+	hint = state['dirty']
+	state['dirty'] = None
+	timer.mark('capture')
+
+	if not reqs and (use_local_engine(syntax) or use_local_fallback(syntax, exclude)):
+		start_time = time.time()
+		result = _local_diff(buf_id, state, content, hint)
+		timer.mark('compute')
+		if result is not None:
+			logger.debug('Diff performed in %.4fs' % (time.time() - start_time))
+			return _on_diff_complete(buf_id, rid, result[0], state['sheet'].source, change_count, result[1])
+
+	# requests of the same buffer are pipelined to the same client,
+	# each one is a diff against source of the previous request
+	if reqs:
+		client = reqs[-1]['client']
+		base = (reqs[-1]['hash'], reqs[-1]['content'])
+	else:
+		client = fallback_client(exclude)
+		base = (_snapshots.hash(buf_id), lambda: _snapshots.get(buf_id, ''))
 
 	if client:
 		logger.debug('Use connected "%s" client for diff' % client.name())
-		lock_state(state)
-		ws.send({
+		data = {'file': buf_id, 'syntax': syntax}
+		add_source(data, 'source1', client, buf_id, base[1], base[0])
+		chash = add_source(data, 'source2', client, buf_id, content, hint=hint, base=base)
+		req = add_request('diff', buf_id, state, rid, client, content=content, hash=chash, change_count=change_count)
+		data['requestId'] = req['id']
+		data['seq'] = req['seq']
+		message = json.dumps({
 			'action': 'diff',
-			'data': {
-				'file': buf_id,
-				'syntax': syntax,
-				'source1': prev_content,
-				'source2': content
-			}
-		}, client)
+			'data': data
+		})
+		timer.mark('serialize')
+		ws.send(message, client, sent=lambda: stats.mark('diff', buf_id, 'send', request=rid))
 	else:
+		stats.cancel('diff', buf_id, rid)
 		logger.error('No suitable client for diff')
 		
-def _on_diff_complete(buf_id, patches, content):
+def _local_diff(buf_id, state, content, hint=None):
+	"""
+	Performs diff with local engine: only top-level rules affected
+	by changed range are compared. Returns tuple of patches and changed
+	range or `None` if diff cannot be performed
+	"""
+	try:
+		prev = state['sheet']
+		if prev is None:
+			prev = css_cache.get(buf_id, _snapshots.get(buf_id, ''))
+
+		changed = textdiff.changed_range(prev.source, content, hint)
+		if changed is None:
+			state['sheet'] = prev
+			return [], None
+
+		sheet = css_parser.update(prev, content, changed)
+		css_cache.put(buf_id, sheet)
+		patches = css_diff.diff(prev, sheet, changed)
+		state['sheet'] = sheet
+		return patches, changed
+	except Exception as e:
+		logger.error('Local diff failed, fall back to browser client: %s' % e)
+
+	return None
+
+def _on_diff_complete(buf_id, rid, patches, content, change_count=None, changed=None):
 	_dispatcher.trigger('diff_complete', buf_id, patches)
+	stats.mark('diff', buf_id, 'publish', request=rid)
+	stats.finish('diff', buf_id, rid)
 
 	if buf_id in _diff_state:
 		state = _diff_state[buf_id]
-		unlock_state(state, 'Diff performed in %.4fs')
 		if patches is not None:
-			state['content'] = content
+			_snapshots.put(buf_id, content, changed)
+			if state['sheet'] is not None and state['sheet'].source is not content:
+				state['sheet'] = None
+			state['change_count'] = change_count
 
 		if state['required']:
-			diff(buf_id)
+			_diff(buf_id)
+
+def drop_sheet(buf_id):
+	"Drops parse tree of given buffer snapshot, it's re-created on next diff"
+	state = _diff_state.get(buf_id)
+	if state is not None:
+		state['sheet'] = None
+
+def deactivate(buf_id):
+	"Releases data of given buffer that is required while it's edited only"
+	# perform pending diff while parse tree is still there
+	_scheduler.flush(buf_id)
+	drop_sheet(buf_id)
+
+def release(buf_id):
+	"Releases all diff and patch data of given buffer"
+	for kind, store in (('diff', _diff_state), ('patch', _patch_state)):
+		if buf_id in store:
+			drop_requests(kind, buf_id, store[buf_id])
+			del store[buf_id]
+
+	_scheduler.cancel(buf_id)
+	_snapshots.remove(buf_id)
+	forget_sources(buf_id=buf_id)
+	css_cache.remove(buf_id)
+	stats.remove(buf_id)
 
 ###############################
 # Patch
@@ -136,59 +529,105 @@ def patch(buf_id, patches):
 	logger.debug('Request patching')
 	if buf_id not in _patch_state:
 		_patch_state[buf_id] = {
-			'running': False,
 			'patches': [],
-			'start_time': 0
+			'requests': [],
+			'seq': 0,
+			'retries': 0
 		}
 
 	state = _patch_state[buf_id]
 	patches = eutils.parse_json(patches) or []
 
-	if is_locked(state):
+	# patched source replaces editor content, so patch
+	# requests can't be pipelined
+	if not can_request('patch', buf_id, state):
 		logger.debug('Batch patches')
 		state['patches'] += patches
 	elif patches:
 		logger.debug('Start patching')
 		_start_patch(buf_id, patches)
 
-def _start_patch(buf_id, patch):
+def _start_patch(buf_id, patch, exclude=None):
 	view = eutils.view_for_buffer_id(buf_id)
 	if view is None:
 		logger.debug('No view to patch')
 		return
 
+	rid = next_request_id()
+	timer = stats.start('patch', buf_id, eutils.file_name(view), rid)
 	content = eutils.content(view)
 	syntax = get_syntax(view)
 	state = _patch_state[buf_id]
+	timer.mark('capture')
+
+	# a burst of patches (like dragging a value in DevTools)
+	# is applied as a single patch per rule
+	tree = css_cache.get(buf_id, content) if syntax == 'css' else None
+	patch = css_patch.compact(patch, tree)
+	if not patch:
+		stats.cancel('patch', buf_id, rid)
+		logger.debug('Patches cancel each other, nothing to apply')
+		return
 
+	timer.mark('compact')
+	if use_local_engine(syntax) or use_local_fallback(syntax, exclude):
+		start_time = time.time()
+		result = _local_patch(buf_id, content, patch)
+		timer.mark('compute')
+		if result is not None:
+			logger.debug('Patch performed in %.4fs' % (time.time() - start_time))
+			return _on_patch_complete(buf_id, rid, result)
 
-	client = ws.find_client({'supports': 'css'})
+	client = fallback_client(exclude)
 	logger.debug('Client: %s' % client)
 
 	if client:
 		logger.debug('Use connected "%s" client for patching' % client.name())
-		lock_state(state)
-		ws.send({
+		data = {'file': buf_id, 'syntax': syntax, 'patches': patch}
+		add_source(data, 'source', client, buf_id, content)
+		# keep sent patches to re-send them if client disconnects
+		req = add_request('patch', buf_id, state, rid, client, sent=patch)
+		data['requestId'] = req['id']
+		data['seq'] = req['seq']
+		message = {
 			'action': 'patch',
-			'data': {
-				'file': buf_id,
-				'syntax': syntax,
-				'patches': patch,
-				'source': content
-			}
-		}, client)
+			'data': data
+		}
+		if ws.supports(client, wire.FEATURE):
+			message = wire.encode_message(message)
+		message = json.dumps(message)
+		timer.mark('serialize')
+		ws.send(message, client, sent=lambda: stats.mark('patch', buf_id, 'send', request=rid))
 	else:
+		stats.cancel('patch', buf_id, rid)
 		logger.error('No suitable client for patching')
 
-def _on_patch_complete(buf_id, content):
+def _local_patch(buf_id, source, patches):
+	"""
+	Applies patches with local engine. Returns payload with minimal
+	edits for `livestyle_replace_content` command or `None` if
+	patches cannot be applied
+	"""
+	try:
+		edits, sheet = css_patch.patch(source, patches, css_cache.get(buf_id, source))
+		css_cache.put(buf_id, sheet)
+		return {'edits': edits}
+	except Exception as e:
+		logger.error('Local patching failed, fall back to browser client: %s' % e)
+
+	return None
+
+def _on_patch_complete(buf_id, rid, content):
 	_dispatcher.trigger('patch_complete', buf_id, content)
+	stats.mark('patch', buf_id, 'apply', request=rid)
+	stats.finish('patch', buf_id, rid)
 
 	if buf_id in _patch_state:
 		state = _patch_state[buf_id]
-		unlock_state(state, 'Patch performed in %.4fs')
 		if state['patches']:
-			patch(buf_id, state['patches'])
+			patches = state['patches']
 			state['patches'] = []
+			patch(buf_id, patches)
 
 
 def is_valid_patch(content):
@@ -239,23 +678,77 @@ def _stringify_selectors(patch):
 
 @eutils.main_thread
 def _on_diff_editor_sources(data, sender):
+	buf_id = data.get('file')
+	state = _diff_state.get(buf_id)
+	req = take_request('diff', buf_id, state, data, sender)
+	if req is None:
+		logger.debug('Discard stale diff response')
+		return
+
+	stats.mark('diff', buf_id, 'dispatch', request=req['id'])
 	logger.debug('Received diff sources response: %s' % ws.format_message(data))
-	if not data['success']:
-		logger.error('[ws] %s' % data.get('result', ''))
-		_on_diff_complete(data.get('file'), None, None)
+	if not data['success'] or req.get('lost'):
+		if not data['success']:
+			logger.error('[ws] %s' % data.get('result', ''))
+
+		if data.get('missingSource'):
+			# client cannot restore source from hash or delta: resync with full source
+			forget_sources(sender, buf_id)
+			state['required'] = True
+
+		if req.get('lost') or state['requests']:
+			# pipelined requests are diffs against unconfirmed sources:
+			# drop them and diff against the last confirmed snapshot
+			drop_requests('diff', buf_id, state)
+			state['required'] = True
+
+		_on_diff_complete(buf_id, req['id'], None, None)
 	else:
 		r = data.get('result', {})
-		_on_diff_complete(data.get('file'), r.get('patches'), r.get('source'))
+		_on_diff_complete(buf_id, req['id'], r.get('patches'), req['content'], req['change_count'])
 
 @eutils.main_thread
 def _on_patch_editor_sources(data, sender):
+	buf_id = data.get('file')
+	state = _patch_state.get(buf_id)
+	req = take_request('patch', buf_id, state, data, sender)
+	if req is None:
+		logger.debug('Discard stale patch response')
+		return
+
+	stats.mark('patch', buf_id, 'dispatch', request=req['id'])
 	logger.debug('Received patched source: %s' % ws.format_message(data))
 	if not data['success']:
 		logger.error('[ws] %s' % data.get('result', ''))
-		_on_patch_complete(data.get('file'), None)
+		if data.get('missingSource'):
+			# client cannot restore source from hash or delta: resync with full source
+			forget_sources(sender, buf_id)
+			state['patches'] = req['sent'] + state['patches']
+		_on_patch_complete(buf_id, req['id'], None)
 	else:
 		r = data.get('result', {})
-		_on_patch_complete(data.get('file'), r)
+		_on_patch_complete(buf_id, req['id'], r)
+
+@eutils.main_thread
+def _on_client_close(client):
+	"Re-sends requests that were in flight to disconnected client"
+	forget_sources(client)
+	for buf_id, state in list(_diff_state.items()):
+		if any(r['client'] is client for r in state['requests']):
+			logger.info('Client disconnected during diff, retrying')
+			drop_requests('diff', buf_id, state)
+			_diff(buf_id)
+
+	for buf_id, state in list(_patch_state.items()):
+		lost = [r for r in state['requests'] if r['client'] is client]
+		if lost:
+			logger.info('Client disconnected during patching, retrying')
+			drop_requests('patch', buf_id, state)
+			patches = sum([r['sent'] for r in lost], []) + state['patches']
+			state['patches'] = []
+			if patches:
+				_start_patch(buf_id, patches)
 
 ws.on('diff', _on_diff_editor_sources)
 ws.on('patch', _on_patch_editor_sources)
+ws.on('ws_close', _on_client_close)
@@ -6,10 +6,36 @@ import sublime
 import sublime_plugin
 
 import re
+import json
+import logging
+import threading
+import collections
 
 re_css = re.compile(r'\.css$', re.IGNORECASE)
 _settings = None
 
+# Lookup index of opened views: view id -> view,
+# view id -> (buffer id, file name) and reverse lookups
+_views = {}
+_view_keys = {}
+_by_buffer = {}
+_by_file = {}
+
+# Cached CSS classification of views: view id -> {strict flag: result}
+_css_views = {}
+
+# File names views were loaded or saved with, used to detect renames:
+# view id -> file name. Unlike lookup index, it's updated on save only
+_saved_names = {}
+
+# Calls queued for main thread as (fn, args, kwargs) tuples. Queue
+# is filled from any thread and drained by a single main thread pump
+_main_queue = collections.deque()
+_main_queue_lock = threading.Lock()
+_pump_scheduled = False
+
+logger = logging.getLogger('livestyle')
+
 try:
 	isinstance("", basestring)
 	def isstr(s):
@@ -20,12 +46,58 @@ except NameError:
 
 def main_thread(fn):
 	"Run function in main thread"
-	return lambda *args, **kwargs: sublime.set_timeout(lambda: fn(*args, **kwargs), 1)
+	return lambda *args, **kwargs: _enqueue(fn, args, kwargs)
+
+def merge_calls(merge):
+	"""
+	Decorator for functions queued by `main_thread`: two consecutive
+	queued calls of decorated function are replaced with a single call
+	with `merge(prev_args, args)` arguments, unless it returns `None`
+	"""
+	def decorator(fn):
+		fn.merge_calls = merge
+		return fn
+	return decorator
+
+def _enqueue(fn, args, kwargs):
+	global _pump_scheduled
+	with _main_queue_lock:
+		merge = getattr(fn, 'merge_calls', None)
+		if merge and _main_queue:
+			prev_fn, prev_args, prev_kwargs = _main_queue[-1]
+			if prev_fn is fn and prev_kwargs == kwargs:
+				merged = merge(prev_args, args)
+				if merged is not None:
+					_main_queue[-1] = (fn, merged, kwargs)
+					return
+
+		_main_queue.append((fn, args, kwargs))
+		if _pump_scheduled:
+			return
+		_pump_scheduled = True
+
+	sublime.set_timeout(_pump_main_queue, 1)
+
+def _pump_main_queue():
+	"Performs all calls queued for main thread"
+	global _pump_scheduled
+	with _main_queue_lock:
+		calls = list(_main_queue)
+		_main_queue.clear()
+		_pump_scheduled = False
+
+	for fn, args, kwargs in calls:
+		try:
+			fn(*args, **kwargs)
+		except Exception:
+			logger.exception('Error in main thread call')
 
 def get_setting(name, default=None):
 	global _settings
 	if not _settings:
 		_settings = sublime.load_settings('LiveStyle.sublime-settings')
+		_settings.clear_on_change('livestyle_css_views')
+		_settings.add_on_change('livestyle_css_views', _css_views.clear)
 
 	return _settings.get(name, default)
 
@@ -53,21 +125,85 @@ def all_views():
 
 	return views
 
-def view_for_buffer_id(buf_id):
-	"Returns view for given buffer id"
+def index_view(view):
+	"Adds given view into lookup index or updates its entry"
+	vid = view.id()
+	prev = _view_keys.get(vid)
+	key = (view.buffer_id(), file_name(view))
+	if prev != key:
+		if prev:
+			_unindex_key(vid, prev)
+			# file name affects CSS classification
+			_css_views.pop(vid, None)
+		_view_keys[vid] = key
+		_views[vid] = view
+		_by_buffer.setdefault(key[0], []).append(vid)
+		_by_file.setdefault(key[1], []).append(vid)
+
+def unindex_view(view):
+	"Removes given view from lookup index"
+	vid = view.id()
+	key = _view_keys.pop(vid, None)
+	if key:
+		_unindex_key(vid, key)
+	_views.pop(vid, None)
+	_css_views.pop(vid, None)
+	_saved_names.pop(vid, None)
+
+def reindex_views():
+	"Rebuilds lookup index from all opened views"
+	for store in (_views, _view_keys, _by_buffer, _by_file, _css_views, _saved_names):
+		store.clear()
+
 	for view in all_views():
-		if view.buffer_id() == buf_id:
+		index_view(view)
+		remember_file_name(view)
+
+def remember_file_name(view):
+	"Remembers current file name of given view to detect its renaming on save"
+	_saved_names[view.id()] = file_name(view)
+
+def renamed_file(view):
+	"""
+	Returns file name given view had before it was saved under
+	another name, `None` if it wasn't renamed. Remembers current name
+	"""
+	vid = view.id()
+	old_name = _saved_names.get(vid)
+	new_name = _saved_names[vid] = file_name(view)
+	return old_name if old_name and old_name != new_name else None
+
+def has_views(buf_id):
+	"Check if there are indexed views of given buffer"
+	return bool(_by_buffer.get(buf_id))
+
+def _unindex_key(vid, key):
+	for store, k in ((_by_buffer, key[0]), (_by_file, key[1])):
+		ids = store.get(k)
+		if ids and vid in ids:
+			ids.remove(vid)
+			if not ids:
+				del store[k]
+
+def _lookup(store, key, matches):
+	"""
+	Finds indexed view. Index is kept up to date by view lifecycle
+	events, so a miss means there's no such view
+	"""
+	for vid in store.get(key, []):
+		view = _views.get(vid)
+		if view is not None and matches(view):
 			return view
 
 	return None
 
+def view_for_buffer_id(buf_id):
+	"Returns view for given buffer id"
+	return _lookup(_by_buffer, buf_id, lambda view: view.buffer_id() == buf_id)
+
 def view_for_file(path):
 	"Locates editor view with given file path"
-	for view in all_views():
-		if file_name(view) == path:
-			return view
-
-	return None
+	return _lookup(_by_file, path, lambda view: file_name(view) == path)
 
 def active_view():
 	"Returns currently active view"
@@ -75,14 +211,29 @@ def active_view():
 
 def css_views():
 	"Returns list of opened CSS views"
-	return [view for view in all_views() if is_css_view(view)]
+	return [view for view in _views.values() if is_css_view(view)]
 
 def css_files():
 	"Returns list of opened CSS files"
-	return [file_name(view) for view in css_views()]
+	return sorted(file_name(view) for view in css_views())
 
 def is_css_view(view, strict=False):
-	"Check if given view can be used for live CSS"
+	"""
+	Check if given view can be used for live CSS.
+	Result is cached until view syntax or settings are changed
+	"""
+	vid = view.id()
+	cache = _css_views.get(vid)
+	if cache is None:
+		cache = _css_views[vid] = {}
+		_watch_syntax(view)
+
+	if strict not in cache:
+		cache[strict] = _is_css_view(view, strict)
+
+	return cache[strict]
+
+def _is_css_view(view, strict=False):
 	sel = get_setting('css_files_selector', 'source.css - source.css.less')
 	if not view.file_name() and not strict:
 		# For new files, check if current scope is text.plain (just created)
@@ -91,6 +242,21 @@ def is_css_view(view, strict=False):
 
 	return view.score_selector(0, sel) > 0
 
+def _watch_syntax(view):
+	"Resets cached CSS classification of given view when its syntax changes"
+	vid = view.id()
+	settings = view.settings()
+	syntax = [settings.get('syntax')]
+
+	def on_change():
+		cur = settings.get('syntax')
+		if cur != syntax[0]:
+			syntax[0] = cur
+			_css_views.pop(vid, None)
+
+	settings.clear_on_change('livestyle_css_view')
+	settings.add_on_change('livestyle_css_view', on_change)
+
 def unindent_text(text, pad):
 	"""
 	Removes padding at the beginning of each text's line
@@ -0,0 +1,43 @@
+# Versioned registry of opened CSS files: produces deltas
+# between file list updates
+
+class FileRegistry():
+	def __init__(self):
+		self.files = []
+		self.version = 0
+
+	def update(self, files):
+		"""
+		Updates registry with current file list. Returns delta
+		of changes or `None` if nothing changed
+		"""
+		prev = set(self.files)
+		cur = set(files)
+		added = [f for f in files if f not in prev]
+		removed = [f for f in self.files if f not in cur]
+		self.files = list(files)
+
+		if not added and not removed:
+			return None
+
+		self.version += 1
+		return {
+			'version': self.version,
+			'added': added,
+			'removed': removed
+		}
+
+	def rename(self, old_name, new_name):
+		"""
+		Renames file in registry. Returns delta of changes or
+		`None` if there's no such file
+		"""
+		if old_name not in self.files:
+			return None
+
+		self.files = [new_name if f == old_name else f for f in self.files]
+		self.version += 1
+		return {
+			'version': self.version,
+			'renamed': [[old_name, new_name]]
+		}
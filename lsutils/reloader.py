@@ -12,9 +12,19 @@ for mod in sys.modules:
 
 mods_load_order = [
 	'lsutils.event_dispatcher',
+	'lsutils.stats',
+	'lsutils.file_registry',
 	'lsutils.editor',
+	'lsutils.wire',
 	'lsutils.websockets',
 	'lsutils.webkit_installer',
+	'lsutils.textdiff',
+	'lsutils.snapshots',
+	'lsutils.scheduler',
+	'lsutils.css_parser',
+	'lsutils.css_diff',
+	'lsutils.css_patch',
+	'lsutils.css_cache',
 	'lsutils.diff'
 ]
 
@@ -0,0 +1,66 @@
+"""
+Debouncing task scheduler: coalesces bursts of requests for the same
+key into a single task call, performed after a quiet period but no later
+than maximum latency since the first request of the burst
+"""
+
+import time
+import sublime
+
+class Scheduler(object):
+	def __init__(self, debounce=0, max_latency=0):
+		"""
+		@param debounce: Quiet period after last request, in milliseconds
+		@param max_latency: Maximum delay of task since the first request
+		of the burst, in milliseconds
+		"""
+		self.debounce = debounce
+		self.max_latency = max_latency
+		self._tasks = {}
+
+	def schedule(self, key, fn):
+		"""
+		Schedules `fn` call for given key. Previously scheduled
+		but not yet performed task of the same key is superseded
+		"""
+		now = time.time()
+		task = self._tasks.get(key)
+		if task is None:
+			task = self._tasks[key] = {'first': now, 'generation': 0}
+
+		task['fn'] = fn
+		task['generation'] += 1
+
+		delay = self.debounce
+		if self.max_latency:
+			delay = min(delay, int((task['first'] - now) * 1000 + self.max_latency))
+
+		if delay <= 0:
+			return self.flush(key)
+
+		generation = task['generation']
+		sublime.set_timeout(lambda: self._fire(key, generation), delay)
+
+	def flush(self, key):
+		"Immediately performs pending task of given key, if any"
+		task = self._tasks.pop(key, None)
+		if task is not None:
+			task['fn']()
+
+	def cancel(self, key):
+		"Cancels pending task of given key"
+		self._tasks.pop(key, None)
+
+	def pending(self, key):
+		"Check if there's a pending task for given key"
+		return key in self._tasks
+
+	def depth(self):
+		"Returns number of pending tasks"
+		return len(self._tasks)
+
+	def _fire(self, key, generation):
+		task = self._tasks.get(key)
+		# task is either performed or superseded by newer request
+		if task is not None and task['generation'] == generation:
+			self.flush(key)
@@ -0,0 +1,150 @@
+"""
+Compact storage of buffer content snapshots.
+
+Each snapshot is stored as a list of compressed chunks split on line
+boundaries. When snapshot of the same buffer is updated, only chunks
+affected by changed range are re-compressed, the rest are reused
+from previous snapshot. Number of stored snapshots is bound by
+least recently used policy
+"""
+
+import zlib
+import hashlib
+
+import lsutils.textdiff as textdiff
+
+CHUNK_SIZE = 16384
+
+def content_hash(content):
+	"Returns hash of given content"
+	return hashlib.md5(content.encode('utf-8')).hexdigest()
+
+class Snapshot(object):
+	"Content snapshot: a content hash and a list of `(length, compressed)` chunks"
+	__slots__ = ('hash', 'size', 'chunks')
+
+	def __init__(self, hash, size, chunks):
+		self.hash = hash
+		self.size = size
+		self.chunks = chunks
+
+	def content(self):
+		return u''.join(zlib.decompress(c).decode('utf-8') for l, c in self.chunks)
+
+class SnapshotStore(object):
+	def __init__(self, limit=None, on_evict=None):
+		self.limit = limit
+		self.on_evict = on_evict
+		self._items = {}
+		self._order = []
+
+	def __contains__(self, key):
+		return key in self._items
+
+	def __len__(self):
+		return len(self._items)
+
+	def get(self, key, default=None):
+		"Returns content of stored snapshot"
+		snapshot = self._items.get(key)
+		if snapshot is None:
+			return default
+
+		self.touch(key)
+		return snapshot.content()
+
+	def hash(self, key):
+		"Returns content hash of stored snapshot"
+		snapshot = self._items.get(key)
+		return snapshot and snapshot.hash
+
+	def put(self, key, content, changed=None):
+		"""
+		Stores snapshot of given content. `changed` is an optional
+		`(start, old_end, new_end)` range of content changed since
+		previous snapshot of the same key
+		"""
+		prev = self._items.get(key)
+		chash = content_hash(content)
+		if prev is not None and prev.hash == chash:
+			self.touch(key)
+			return
+
+		if prev is None:
+			chunks = make_chunks(content, 0, len(content))
+		else:
+			if changed is None:
+				changed = textdiff.changed_range(prev.content(), content)
+			chunks = update_chunks(prev.chunks, content, changed)
+
+		self._items[key] = Snapshot(chash, len(content), chunks)
+		self.touch(key)
+		self._evict()
+
+	def remove(self, key):
+		"Removes snapshot of given key"
+		if key in self._items:
+			del self._items[key]
+			self._order.remove(key)
+
+	def keys(self):
+		return list(self._order)
+
+	def touch(self, key):
+		"Marks given key as recently used"
+		if key in self._order:
+			if self._order[-1] == key:
+				return
+			self._order.remove(key)
+		self._order.append(key)
+
+	def _evict(self):
+		while self.limit and len(self._order) > self.limit:
+			key = self._order[0]
+			self.remove(key)
+			if self.on_evict:
+				self.on_evict(key)
+
+def make_chunks(content, start, end):
+	"Splits given content range into compressed chunks"
+	chunks = []
+	while start < end:
+		split = end
+		if end - start > CHUNK_SIZE:
+			# split chunk at line boundary
+			split = content.find('\n', start + CHUNK_SIZE, end)
+			split = end if split == -1 else split + 1
+
+		chunks.append((split - start, zlib.compress(content[start:split].encode('utf-8'), 1)))
+		start = split
+
+	return chunks
+
+def update_chunks(chunks, content, changed):
+	"""
+	Returns list of chunks for updated content: chunks that
+	are not affected by changed range are reused
+	"""
+	if changed is None:
+		return chunks
+
+	start, old_end, new_end = changed
+	head = []
+	pos = 0
+	ix = 0
+
+	# chunks before changed range
+	while ix < len(chunks) and pos + chunks[ix][0] < start:
+		head.append(chunks[ix])
+		pos += chunks[ix][0]
+		ix += 1
+
+	region_start = pos
+
+	# chunks after changed range
+	while ix < len(chunks) and pos < old_end:
+		pos += chunks[ix][0]
+		ix += 1
+
+	region_end = pos + new_end - old_end if pos >= old_end else len(content)
+	return head + make_chunks(content, region_start, region_end) + chunks[ix:]
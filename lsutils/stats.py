@@ -0,0 +1,157 @@
+"""
+Latency statistics of diff and patch requests.
+
+Each request is measured by a `Timer` that records duration of
+request stages (content capture, serialization, websocket send,
+remote compute, response parse and so on) into per-buffer histograms
+"""
+
+import time
+import threading
+import collections
+
+# Number of recent samples kept per stage
+SAMPLES = 1000
+
+# buf_id -> {'name': file name, 'stages': {stage: Histogram}}
+_stats = {}
+
+# Requests in progress: (kind, buf_id, request) -> Timer
+_timers = {}
+
+# name -> function that returns current value of gauge, like queue depth
+_gauges = {}
+
+# Statistics are recorded in main thread and websockets thread,
+# and reported in websockets thread
+_lock = threading.Lock()
+
+class Histogram(object):
+	"Keeps most recent samples and reports their percentiles"
+	def __init__(self, size=SAMPLES):
+		self.samples = collections.deque(maxlen=size)
+		self.count = 0
+
+	def add(self, value):
+		self.samples.append(value)
+		self.count += 1
+
+	def percentile(self, p):
+		"Returns `p`-th percentile of recent samples"
+		if not self.samples:
+			return None
+
+		values = sorted(self.samples)
+		ix = int(round(p / 100.0 * (len(values) - 1)))
+		return values[ix]
+
+	def summary(self):
+		"Returns dict with percentiles of recent samples, in milliseconds"
+		ms = lambda v: round(v * 1000, 3)
+		return {
+			'count': self.count,
+			'p50': ms(self.percentile(50)),
+			'p99': ms(self.percentile(99)),
+			'max': ms(max(self.samples))
+		}
+
+class Timer(object):
+	"Measures consecutive stages of a single request"
+	def __init__(self, kind, buf_id, request=None):
+		self.kind = kind
+		self.buf_id = buf_id
+		self.request = request
+		self.start = self.last = time.time()
+
+	def mark(self, stage, at=None):
+		"Records duration of given stage, finished at `at` time or now"
+		if at is None:
+			at = time.time()
+		record(self.buf_id, '%s.%s' % (self.kind, stage), at - self.last)
+		self.last = at
+
+	def finish(self):
+		"Records total request duration"
+		record(self.buf_id, '%s.total' % self.kind, time.time() - self.start)
+		cancel(self.kind, self.buf_id, self.request)
+
+def start(kind, buf_id, name=None, request=None):
+	"""
+	Starts measuring new request of given kind (`diff` or `patch`),
+	identified by `request` id. Previous unfinished request with
+	the same id is discarded
+	"""
+	with _lock:
+		entry = _stats.setdefault(buf_id, {'name': None, 'stages': {}})
+		if name:
+			entry['name'] = name
+
+	t = _timers[(kind, buf_id, request)] = Timer(kind, buf_id, request)
+	return t
+
+def timer(kind, buf_id, request=None):
+	"""
+	Returns timer of request in progress, if any. If request
+	id is unknown, returns timer of the oldest request of buffer
+	"""
+	t = _timers.get((kind, buf_id, request))
+	if t is None and request is None:
+		keys = [k for k in list(_timers.keys()) if k[0] == kind and k[1] == buf_id]
+		if keys:
+			t = _timers.get(min(keys, key=lambda k: k[2] or 0))
+
+	return t
+
+def mark(kind, buf_id, stage, at=None, request=None):
+	"Records stage of request in progress, if any"
+	t = timer(kind, buf_id, request)
+	if t is not None:
+		t.mark(stage, at)
+
+def finish(kind, buf_id, request=None):
+	t = timer(kind, buf_id, request)
+	if t is not None:
+		t.finish()
+
+def cancel(kind, buf_id, request=None):
+	"Stops measuring request without recording its total duration"
+	_timers.pop((kind, buf_id, request), None)
+
+def record(buf_id, stage, duration):
+	"Records duration of request stage, in seconds"
+	with _lock:
+		entry = _stats.setdefault(buf_id, {'name': None, 'stages': {}})
+		if stage not in entry['stages']:
+			entry['stages'][stage] = Histogram()
+		entry['stages'][stage].add(duration)
+
+def remove(buf_id):
+	"Removes statistics of given buffer"
+	with _lock:
+		_stats.pop(buf_id, None)
+
+	for key in list(_timers.keys()):
+		if key[1] == buf_id:
+			_timers.pop(key, None)
+
+def gauge(name, fn):
+	"Registers function that reports current value of `name` gauge"
+	_gauges[name] = fn
+
+def report():
+	"""
+	Returns statistics of all buffers and current values
+	of gauges as JSON-serializable dict
+	"""
+	out = {}
+	with _lock:
+		for buf_id, entry in _stats.items():
+			out[str(buf_id)] = {
+				'file': entry['name'],
+				'stages': dict((k, h.summary()) for k, h in entry['stages'].items())
+			}
+
+	return {
+		'buffers': out,
+		'gauges': dict((name, fn()) for name, fn in list(_gauges.items()))
+	}
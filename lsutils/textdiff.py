@@ -0,0 +1,108 @@
+"""
+Helpers for finding changed regions between two revisions
+of the same text
+"""
+
+import difflib
+
+def common_prefix(a, b, known=0):
+	"""
+	Returns length of common prefix of given strings.
+	`known` is a length of prefix known to be equal
+	"""
+	lo, hi = known, min(len(a), len(b))
+	# compare halves of remaining ranges: string comparison is
+	# much faster than character-by-character loop
+	while lo < hi:
+		mid = (lo + hi + 1) // 2
+		if a[lo:mid] == b[lo:mid]:
+			lo = mid
+		else:
+			hi = mid - 1
+
+	return lo
+
+def common_suffix(a, b, limit=None, known=0):
+	"""
+	Returns length of common suffix of given strings. Suffix
+	length is limited by `limit` chars, `known` is a length
+	of suffix known to be equal
+	"""
+	la, lb = len(a), len(b)
+	lo, hi = known, min(la, lb)
+	if limit is not None:
+		hi = min(hi, limit)
+
+	while lo < hi:
+		mid = (lo + hi + 1) // 2
+		if a[la - mid:la - lo] == b[lb - mid:lb - lo]:
+			lo = mid
+		else:
+			hi = mid - 1
+
+	return lo
+
+def changed_range(a, b, hint=None):
+	"""
+	Returns changed range between `a` and `b` strings as
+	`(start, a_end, b_end)` tuple or `None` if strings are equal.
+	`hint` is an optional `(start, end)` region of `b` that is expected
+	to contain all the changes: it's verified and used to narrow the search
+	"""
+	if a is b or a == b:
+		return None
+
+	la, lb = len(a), len(b)
+	prefix = suffix = 0
+	if hint:
+		prefix = max(0, min(hint[0], la, lb))
+		if a[:prefix] != b[:prefix]:
+			prefix = 0
+
+		suffix = max(0, min(lb - hint[1], la - prefix, lb - prefix))
+		if suffix and a[la - suffix:] != b[lb - suffix:]:
+			suffix = 0
+
+	start = common_prefix(a, b, prefix)
+	suffix = common_suffix(a, b, min(la, lb) - start, min(suffix, min(la, lb) - start))
+	return start, la - suffix, lb - suffix
+
+def edits(a, b, max_lines=2000):
+	"""
+	Returns list of `[start, end, text]` edits that transform `a` into `b`.
+	Edits are ordered from the end of text so they can be applied
+	one by one. Changed range is compared line by line, unless it's
+	larger than `max_lines`
+	"""
+	changed = changed_range(a, b)
+	if changed is None:
+		return []
+
+	start, a_end, b_end = changed
+	line_start = a.rfind('\n', 0, start) + 1
+	line_end = a.find('\n', a_end)
+	line_end = len(a) if line_end == -1 else line_end + 1
+	a_lines = a[line_start:line_end].splitlines(True)
+	b_lines = b[line_start:line_end + b_end - a_end].splitlines(True)
+
+	if len(a_lines) < 2 or len(b_lines) < 2 or max(len(a_lines), len(b_lines)) > max_lines:
+		return [[start, a_end, b[start:b_end]]]
+
+	out = []
+	offsets = [line_start]
+	for line in a_lines:
+		offsets.append(offsets[-1] + len(line))
+
+	matcher = difflib.SequenceMatcher(None, a_lines, b_lines)
+	for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+		if tag == 'equal':
+			continue
+
+		old_text = ''.join(a_lines[i1:i2])
+		new_text = ''.join(b_lines[j1:j2])
+		r = changed_range(old_text, new_text)
+		if r is not None:
+			out.append([offsets[i1] + r[0], offsets[i1] + r[1], new_text[r[0]:r[2]]])
+
+	out.reverse()
+	return out
@@ -1,4 +1,5 @@
 import json
+import time
 import logging
 import threading
 
@@ -20,11 +21,14 @@ except ImportError:
 # import tornado.process
 import tornado.ioloop
 import tornado.options
+import tornado.escape
 import tornado.web
 import tornado.websocket
 import tornado.httpserver
 
 import lsutils.editor as eutils
+import lsutils.stats as stats
+import lsutils.wire as wire
 from lsutils.event_dispatcher import EventDispatcher
 
 # Tornado server instance
@@ -34,25 +38,50 @@ logger = logging.getLogger('livestyle')
 
 broadcast_events = ['update']
 
+# Responses to requests measured by `stats` module
+timed_events = ['diff', 'patch']
+
 # Websockets event dispatcher
 _dispatcher = EventDispatcher()
 
+# Load of clients that handle diff and patch requests:
+# client -> {'pending': requests in flight, 'latency': average response time}
+_load = {}
+
 class LiveStyleIDHandler(tornado.web.RequestHandler):
 	def get(self):
 		self.write('LiveStyle websockets server is up and running')
 
+class LiveStyleStatsHandler(tornado.web.RequestHandler):
+	"Reports diff and patch latency percentiles per buffer and diff queue depth"
+	def get(self):
+		self.set_header('Content-Type', 'application/json')
+		self.write(json.dumps(stats.report(), indent=2, sort_keys=True))
+
 class WSHandler(tornado.websocket.WebSocketHandler):
 	clients = set()
+	# permessage-deflate options, `None` disables compression
+	compression_options = None
+
+	def get_compression_options(self):
+		return WSHandler.compression_options
+
 	def open(self):
 		logger.debug('client connected')
 		WSHandler.clients.add(self)
 		_dispatcher.trigger('ws_open', self)
 	
 	def on_message(self, message):
+		received = time.time()
 		logger.debug('message received:\n%s' % format_message(message))
 		_dispatcher.trigger('ws_message', message, self)
 
-		message = json.loads(message)
+		message = wire.decode_message(json.loads(message))
+		if message['action'] in timed_events and isinstance(message.get('data'), dict):
+			buf_id = message['data'].get('file')
+			request = message['data'].get('requestId')
+			stats.mark(message['action'], buf_id, 'remote', received, request)
+			stats.mark(message['action'], buf_id, 'parse', request=request)
 		_dispatcher.trigger(message['action'], message.get('data'), self)
 
 		if message['action'] in broadcast_events:
@@ -65,8 +94,9 @@ class WSHandler(tornado.websocket.WebSocketHandler):
 
 	def on_close(self):
 		logger.debug('client disconnected')
-		_dispatcher.trigger('ws_close', self)
 		WSHandler.clients.discard(self)
+		_load.pop(self, None)
+		_dispatcher.trigger('ws_close', self)
 
 	def name(self):
 		return getattr(self, 'livestyleClientInfo', {}).get('id', 'unknown')
@@ -84,26 +114,89 @@ def format_message(msg):
 	msg = repr(msg)
 	return msg[0:300]
 
-def send(message, client=None, exclude=None):
-	"Sends given message to websocket clients"
-	if not eutils.isstr(message):
-		message = json.dumps(message)
-	clients = WSHandler.clients if not client else [client]
+def send(message, client=None, exclude=None, sent=None):
+	"""
+	Sends given message to websocket clients. Clients that support
+	compact wire format receive patches of the message in this format.
+	Optional `sent` callback is called in IOLoop thread once message
+	is written to clients
+	"""
+	if not client:
+		clients = WSHandler.clients
+	elif isinstance(client, (list, tuple, set)):
+		clients = client
+	else:
+		clients = [client]
+
 	if exclude:
 		clients = [c for c in clients if c != exclude]
 
+	compact = None
+	if not eutils.isstr(message):
+		# serialize message only in formats used by clients
+		if wire.has_patches(message) and any(supports(c, wire.FEATURE) for c in clients):
+			compact = json.dumps(wire.encode_message(message))
+		if compact is not None and all(supports(c, wire.FEATURE) for c in clients):
+			message = compact
+		else:
+			message = json.dumps(message)
+
 	if not clients:
 		logger.debug('Cannot send message, client list empty')
 	else:
 		logger.debug('Sending ws message %s' % format_message(message))
-		for c in clients:
-			c.write_message(message)
+		# messages are sent from both main and IOLoop threads: compressors
+		# of connections are stateful, so frames must be compressed and
+		# written in order, by IOLoop thread only
+		clients = list(clients)
+		tornado.ioloop.IOLoop.instance().add_callback(lambda: _write(clients, message, compact, sent))
+
+def _write(clients, message, compact=None, sent=None):
+	"""
+	Writes message to given clients. Must be called in IOLoop thread.
+	Websocket frame is built once and written to every client that
+	produces identical frames
+	"""
+	frames = {}
+	payloads = {}
+	for c in clients:
+		conn = c.ws_connection
+		if conn is None:
+			# client disconnected since message was sent
+			continue
+
+		fmt = wire.FORMAT if compact is not None and supports(c, wire.FEATURE) else None
+		msg = compact if fmt else message
+		key = None
+		if isinstance(conn, tornado.websocket.WebSocketProtocol13):
+			key = conn.frame_cache_key()
+
+		if key is None:
+			c.write_message(msg)
+			continue
+
+		key = (fmt, key)
+		if key not in frames:
+			if fmt not in payloads:
+				payloads[fmt] = tornado.escape.utf8(msg)
+			frames[key] = conn._build_message_frame(payloads[fmt])
+		conn.write_frame(frames[key])
+
+	if sent is not None:
+		sent()
 
 def clients():
 	return WSHandler.clients
 
-def find_client(flt={}):
-	for c in clients():
+def supports(client, feature):
+	"Check if given client supports feature listed in its handshake"
+	info = getattr(client, 'livestyleClientInfo', None) or {}
+	return feature in info.get('supports', [])
+
+def find_clients(flt={}):
+	"Returns list of clients matching given filter"
+	out = []
+	for c in list(clients()):
 		info = getattr(c, 'livestyleClientInfo', None)
 		if info:
 			is_valid = True
@@ -117,32 +210,86 @@ def find_client(flt={}):
 					break
 
 			if is_valid:
-				return c
+				out.append(c)
 
 		elif not flt:
-			return c
+			out.append(c)
+
+	return out
+
+def find_client(flt={}):
+	matches = find_clients(flt)
+	return matches[0] if matches else None
+
+def pick_client(flt={}, exclude=None):
+	"""
+	Returns least loaded client matching given filter: the one with
+	fewest requests in flight, then with fastest recent responses
+	"""
+	matches = [c for c in find_clients(flt) if c is not exclude]
+	if not matches:
+		return None
+
+	def weight(c):
+		load = _load.get(c) or {}
+		return (load.get('pending', 0), load.get('latency', 0))
+
+	return min(matches, key=weight)
+
+def request_started(client):
+	"Registers request sent to given client"
+	load = _load.setdefault(client, {'pending': 0, 'latency': 0})
+	load['pending'] += 1
+
+def request_finished(client, elapsed=None):
+	"""
+	Registers completed or abandoned request of given client.
+	`elapsed` is a response time, in seconds
+	"""
+	load = _load.get(client)
+	if load is None:
+		return
+
+	load['pending'] = max(0, load['pending'] - 1)
+	if elapsed is not None:
+		# exponential moving average favours recent responses
+		load['latency'] = elapsed if not load['latency'] else load['latency'] * 0.7 + elapsed * 0.3
 
 
 application = tornado.web.Application([
 	(r'/browser', WSHandler),
+	(r'/stats', LiveStyleStatsHandler),
 	(r'/', LiveStyleIDHandler)
 ])
 
-def start(port):
+def start(port, compression=None):
+	"""
+	Starts websockets server on given port.
+	@param compression: permessage-deflate options dict,
+	`None` disables compression
+	"""
 	global httpserver
 	logger.info('Starting LiveStyle server on port %s' % port)
+	WSHandler.compression_options = compression
 	httpserver = tornado.httpserver.HTTPServer(application)
 	httpserver.listen(port, address='127.0.0.1')
 	threading.Thread(target=tornado.ioloop.IOLoop.instance().start).start()
 
 def stop():
 	global httpserver
-	for c in WSHandler.clients.copy():
-		c.close()
+	loop = tornado.ioloop.IOLoop.instance()
+	clients = list(WSHandler.clients)
 	WSHandler.clients.clear()
 
+	def close():
+		# close frames are written in IOLoop thread, after pending messages
+		for c in clients:
+			if c.ws_connection is not None:
+				c.close()
+		loop.stop()
+
 	if httpserver:
 		logger.info('Stopping server')
 		httpserver.stop()
 
-	tornado.ioloop.IOLoop.instance().stop()
+	loop.add_callback(close)
@@ -0,0 +1,127 @@
+"""
+Compact wire format of LiveStyle patches.
+
+Clients that list `compactPatches` in `supports` of their handshake
+receive and may send patches as flat arrays instead of dicts, which
+removes repeated keys and nesting from high-frequency `update` traffic:
+* `update` patch: `[path, properties, removed]`
+* `remove` patch: `[path]`
+
+where `path` is a flat `[name1, pos1, name2, pos2, ...]` list and both
+`properties` and `removed` are flat `[name1, value1, index1, ...]` lists.
+Patches that can't be represented this way, e.g. `add` patches of
+`@import` with `value`, are kept as regular dicts in patch list.
+Messages in compact format have `format: "compact"` key; JSON with
+regular patch dicts is still the default
+"""
+
+import lsutils.editor as eutils
+
+FEATURE = 'compactPatches'
+FORMAT = 'compact'
+
+# Keys of patches that can be encoded in compact format
+_compact_keys = {
+	'update': set(['path', 'action', 'properties', 'removed']),
+	'remove': set(['path', 'action'])
+}
+
+# Location of patch list in data of message with given action
+_patch_keys = {
+	'update': ('patch',),
+	'patch': ('patches',),
+	'diff': ('result', 'patches')
+}
+
+def encode_patch(patch):
+	if not can_encode(patch):
+		return patch
+
+	path = []
+	for name, pos in patch['path']:
+		path.append(name)
+		path.append(pos)
+
+	if patch['action'] == 'remove':
+		return [path]
+
+	return [path, _flat_properties(patch.get('properties')), _flat_properties(patch.get('removed'))]
+
+def decode_patch(data):
+	if isinstance(data, dict):
+		return data
+
+	path = [[data[0][i], data[0][i + 1]] for i in range(0, len(data[0]), 2)]
+	if len(data) == 1:
+		return {'path': path, 'action': 'remove'}
+
+	return {
+		'path': path,
+		'action': 'update',
+		'properties': _property_list(data[1]),
+		'removed': _property_list(data[2])
+	}
+
+def can_encode(patch):
+	"Check if given patch can be encoded in compact format without loss"
+	keys = _compact_keys.get(patch.get('action'))
+	if keys != set(patch):
+		return False
+
+	return all(set(p) == set(['name', 'value', 'index'])
+		for p in (patch.get('properties') or []) + (patch.get('removed') or []))
+
+def _flat_properties(props):
+	out = []
+	for p in props or []:
+		out.append(p['name'])
+		out.append(p.get('value'))
+		out.append(p.get('index'))
+
+	return out
+
+def _property_list(data):
+	return [{'name': data[i], 'value': data[i + 1], 'index': data[i + 2]} for i in range(0, len(data), 3)]
+
+def has_patches(message):
+	"Check if given message carries patches that can be encoded"
+	return message.get('action') in _patch_keys and isinstance(message.get('data'), dict)
+
+def _convert(message, fn, fmt):
+	"""
+	Returns copy of given message with patches converted by `fn`.
+	Only containers on the way to patch list are copied
+	"""
+	keys = _patch_keys[message['action']]
+	out = dict(message)
+	if fmt:
+		out['format'] = fmt
+	else:
+		out.pop('format', None)
+
+	parent = out['data'] = dict(out['data'])
+	for k in keys[:-1]:
+		if not isinstance(parent.get(k), dict):
+			return out
+		parent[k] = dict(parent[k])
+		parent = parent[k]
+
+	patches = eutils.parse_json(parent.get(keys[-1]))
+	if patches:
+		parent[keys[-1]] = [fn(p) for p in patches]
+
+	return out
+
+def encode_message(message):
+	"Returns copy of given message with patches in compact format"
+	if not has_patches(message):
+		return message
+
+	return _convert(message, encode_patch, FORMAT)
+
+def decode_message(message):
+	"Returns copy of given compact message with regular patch dicts"
+	if message.get('format') != FORMAT or not has_patches(message):
+		return message
+
+	return _convert(message, decode_patch, None)
@@ -0,0 +1,45 @@
+import unittest
+
+from lsutils import css_parser, css_diff, textdiff
+
+def diff(source1, source2):
+	return css_diff.diff(css_parser.parse(source1), css_parser.parse(source2))
+
+class DiffTest(unittest.TestCase):
+	def test_update_properties(self):
+		self.assertEqual(diff('a{b:c;d:e}', 'a{b:x;f:g}'), [{
+			'path': [['a', 1]],
+			'action': 'update',
+			'properties': [{'name': 'b', 'value': 'x', 'index': 0}, {'name': 'f', 'value': 'g', 'index': 1}],
+			'removed': [{'name': 'd', 'value': 'e', 'index': 1}]
+		}])
+
+	def test_add_and_remove_rules(self):
+		self.assertEqual(diff('a{b:c}\na{d:e}', 'a{b:c}\n@media print{p{q:r}}'), [
+			{'path': [['@media print', 1]], 'action': 'update', 'properties': [], 'removed': []},
+			{'path': [['@media print', 1], ['p', 1]], 'action': 'update', 'properties': [{'name': 'q', 'value': 'r', 'index': 0}], 'removed': []},
+			{'path': [['a', 2]], 'action': 'remove'}
+		])
+
+	def test_no_changes(self):
+		self.assertEqual(diff('a { b: c }', 'a{b:c}'), [])
+
+	def test_block_less_at_rules(self):
+		self.assertEqual(diff('a{b:c}', '@import url(x.css);\na{b:c}'),
+			[{'path': [['@import', 1]], 'action': 'add', 'value': 'url(x.css)'}])
+		self.assertEqual(diff('@charset "a";', '@charset "b";'),
+			[{'path': [['@charset', 1]], 'action': 'update', 'value': '"b"'}])
+		self.assertEqual(diff('@import a;\n@import b;', '@import b;'), [
+			{'path': [['@import', 1]], 'action': 'update', 'value': 'b'},
+			{'path': [['@import', 2]], 'action': 'remove'}
+		])
+
+	def test_changed_range(self):
+		source1 = '@import a;\na{b:c}\nd{e:f}\nd{g:h}\n'
+		source2 = '@import a;\n@import x;\na{b:c}\nd{g:h}\n'
+		old, new = css_parser.parse(source1), css_parser.parse(source2)
+		changed = textdiff.changed_range(source1, source2)
+		self.assertEqual(css_diff.diff(old, css_parser.update(old, source2, changed), changed), css_diff.diff(old, new))
+
+if __name__ == '__main__':
+	unittest.main()
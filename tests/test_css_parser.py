@@ -0,0 +1,55 @@
+import unittest
+
+from lsutils import css_parser
+
+def shape(nodes):
+	return [(n.type, n.name, n.value, shape(n.children)) for n in nodes]
+
+class ParserTest(unittest.TestCase):
+	def test_rules_and_properties(self):
+		sheet = css_parser.parse('a, b {color: red; margin:0}\n@media print { p { top: 1px } }')
+		a, media = sheet.rules()
+		self.assertEqual(a.name, 'a, b')
+		self.assertEqual([(p.name, p.value) for p in a.properties()], [('color', 'red'), ('margin', '0')])
+		self.assertEqual(media.name, '@media print')
+		self.assertEqual(media.rules()[0].properties()[0].value, '1px')
+
+	def test_comments_and_strings(self):
+		sheet = css_parser.parse('/* a { b: c } */ a { content: "};"; /* x: y; */ b: url(a;b) }')
+		rule, = sheet.rules()
+		self.assertEqual([(p.name, p.value) for p in rule.properties()], [('content', '"};"'), ('b', 'url(a;b)')])
+
+	def test_block_less_at_rules(self):
+		source = '@charset "utf-8";\n@import url(http://a/b.css) print;\na { b: c }'
+		sheet = css_parser.parse(source)
+		charset, imp, rule = sheet.rules()
+		self.assertEqual((charset.type, charset.name, charset.value), ('at-rule', '@charset', '"utf-8"'))
+		self.assertEqual((imp.type, imp.name, imp.value), ('at-rule', '@import', 'url(http://a/b.css) print'))
+		imp = sheet.absolute(imp)
+		self.assertEqual(source[imp.value_start:imp.value_end], imp.value)
+		self.assertEqual(rule.name, 'a')
+
+	def test_nested_at_rules_without_block_are_skipped(self):
+		rule, = css_parser.parse('a { @include foo; b: c }').rules()
+		self.assertEqual(rule.children, rule.properties())
+		self.assertEqual([p.name for p in rule.properties()], ['b'])
+
+	def test_incremental_update(self):
+		source = '@import url(a.css);\na { b: c }\nd { e: f }\n'
+		sheet = css_parser.parse(source)
+		for start, end, text in [(20, 20, '@import url(x.css);\n'), (25, 26, 'color'), (0, 7, '@charset'), (30, 31, '{')]:
+			updated = source[:start] + text + source[end:]
+			sheet = css_parser.update(sheet, updated)
+			self.assertEqual(shape(sheet.nodes), shape(css_parser.parse(updated).nodes))
+			self.assertEqual(sheet.offsets, css_parser.parse(updated).offsets)
+			source = updated
+
+	def test_incremental_update_of_unterminated_tail(self):
+		# unclosed string swallows `;`, so the last node looks terminated
+		for source, updated in [('"a} { }:\';  ', '"a} { }:\'; @import x{ '), ('"\n}"):} ', '"\n}"):} }{'), ('a { b: c', 'a { b: c; d: e }')]:
+			sheet = css_parser.update(css_parser.parse(source), updated)
+			self.assertEqual(shape(sheet.nodes), shape(css_parser.parse(updated).nodes))
+			self.assertEqual(sheet.offsets, css_parser.parse(updated).offsets)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,113 @@
+import unittest
+
+from lsutils import css_parser, css_diff, css_patch
+
+def patched(source, target):
+	patches = css_diff.diff(css_parser.parse(source), css_parser.parse(target))
+	edits, tree = css_patch.patch(source, patches)
+	return css_patch.apply_edits(source, edits), tree
+
+def update(name, props, removed=(), pos=1):
+	as_dicts = lambda items: [{'name': n, 'value': v, 'index': i} for n, v, i in items]
+	return {'path': [[name, pos]], 'action': 'update', 'properties': as_dicts(props), 'removed': as_dicts(removed)}
+
+def properties(tree):
+	return [[(p.name, p.value) for p in r.properties()] for r in tree.rules()]
+
+class PatchTest(unittest.TestCase):
+	def test_update_properties(self):
+		self.assertEqual(patched('a {\n\tb: c;\n\td: e;\n}', 'a{b:x;f:g}')[0], 'a {\n\tb: x;\n\tf: g;\n}')
+
+	def test_create_and_remove_rules(self):
+		result = patched('a { b: c }\np { q: r }\n', 'a { b: c }\n@media print { p { q: r } }\n')[0]
+		self.assertEqual(result, 'a { b: c }\n\n@media print {\n\tp {\n\t\tq: r;\n\t}\n}\n')
+
+	def test_block_less_at_rules(self):
+		self.assertEqual(patched('a{b:c}', '@import url(x.css);\na{b:c}')[0], '@import url(x.css);\na{b:c}')
+		self.assertEqual(patched('@charset "a";\na{}', '@charset "a";\n@import b;\na{}')[0], '@charset "a";\n@import b;\na{}')
+		self.assertEqual(patched('@import a;\n@import b;\nx{}', '@import b;\nx{}')[0], '@import b;\nx{}')
+		self.assertEqual(patched('', '@charset "x";')[0], '@charset "x";')
+
+	def test_browser_patches(self):
+		# browser adds `@import` after leading `@charset` and `@import` rules
+		source = '@charset "a";\n@import a;\nx{}'
+		patches = [{'path': [['@import', 2]], 'action': 'add', 'value': 'url(b.css)'}]
+		self.assertEqual(css_patch.apply_edits(source, css_patch.patch(source, patches)[0]), '@charset "a";\n@import a;\n@import url(b.css);\nx{}')
+		patches = [{'path': [['@import', 1]], 'action': 'update', 'value': 'c'}]
+		self.assertEqual(css_patch.apply_edits(source, css_patch.patch(source, patches)[0]), '@charset "a";\n@import c;\nx{}')
+
+	def test_compact_keeps_at_rules(self):
+		patches = [
+			{'path': [['@import', 1]], 'action': 'add', 'value': 'a'},
+			{'path': [['x', 1]], 'action': 'update', 'properties': [{'name': 'b', 'value': '1', 'index': 0}], 'removed': []},
+			{'path': [['x', 1]], 'action': 'update', 'properties': [{'name': 'b', 'value': '2', 'index': 0}], 'removed': []}
+		]
+		self.assertEqual(css_patch.compact(patches, css_parser.parse('x{b:0}')), [patches[0], patches[2]])
+
+class CompactTest(unittest.TestCase):
+	def assertCompacted(self, source, patches):
+		"Compacted patches produce exactly the same result as patches applied one by one"
+		compacted = css_patch.compact(patches, css_parser.parse(source))
+		self.assertEqual(properties(css_patch.patch(source, compacted)[1]), properties(css_patch.patch(source, patches)[1]))
+		return compacted
+
+	def test_merge_updates(self):
+		patches = [update('a', [('top', '1', 0)]), update('b', [('color', 'red', 0)]), update('a', [('top', '2', 0)])]
+		self.assertEqual(self.assertCompacted('a{top:0}', patches), [update('a', [('top', '2', 0)]), patches[1]])
+
+	def test_keep_patches_merged_differently(self):
+		# merged patch would update `b:1` instead of inserting second `b`
+		patches = [update('x', [('b', '1', 2)]), update('x', [('b', '2', 2)])]
+		self.assertEqual(self.assertCompacted('x{a:0;b:1;a:2}', patches), patches)
+
+	def test_created_rule_with_clamped_path(self):
+		# once `b` is created, `b|2` path is resolved to it
+		patches = [update('b', [('color', '1', 0)]), update('b', [('color', '2', 0)], pos=2), update('b', [('color', '3', 0)])]
+		self.assertCompacted('a{top:0}', patches)
+
+class DuplicatePropertiesTest(unittest.TestCase):
+	def assertPatched(self, source, target):
+		"Patched source has the same `(name, occurrence)` values as target"
+		result, tree = patched(source, target)
+		self.assertEqual(css_diff.diff(css_parser.parse(result), css_parser.parse(target)), [])
+		self.assertEqual(properties(tree), properties(css_parser.parse(result)))
+
+	def test_insert_duplicate_before_last(self):
+		# `color#2=4 @1, color#3=3 @2` must not update the same declaration twice
+		result, tree = patched('f{color:4;color:3}', 'f{color:4;color:4;color:3}')
+		self.assertEqual(properties(tree), [[('color', '4'), ('color', '4'), ('color', '3')]])
+		self.assertEqual(properties(css_parser.parse(result)), properties(tree))
+
+	def test_insert_duplicate_between(self):
+		self.assertPatched(
+			'a {\n\tcolor: red;\n\tcolor: -webkit-red;\n}\n',
+			'a {\n\tcolor: red;\n\tcolor: blue;\n\tcolor: -webkit-red;\n}\n')
+
+	def test_update_and_insert_duplicates(self):
+		self.assertPatched('g{c:1;a:1}', 'g{c:1;a:0;b:3;a:1}')
+		self.assertPatched('g{a:1;b:2;a:3}', 'g{a:1;a:5;b:2;a:3}')
+
+	def test_remove_duplicate(self):
+		self.assertPatched('f{color:1;color:2;color:3}', 'f{color:1;color:3}')
+		self.assertPatched('f{color:1;top:0;color:2}', 'f{color:1;top:0}')
+
+	def test_update_duplicate(self):
+		self.assertPatched('f{color:1;color:2;color:3}', 'f{color:1;color:5;color:3}')
+
+	def test_update_with_same_value(self):
+		patches = [update('a', [('color', 'red', 0)])]
+		self.assertEqual(css_patch.patch('a { color: red; }', patches)[0], [])
+
+	def test_update_with_stale_index(self):
+		source = 'a { color: red; margin: 0; }'
+		edits = css_patch.patch(source, [update('a', [('margin', '1', 5)])])[0]
+		self.assertEqual(css_patch.apply_edits(source, edits), 'a { color: red; margin: 1; }')
+
+	def test_update_moved_property(self):
+		source = 'b{x:2;color:3;margin:3}'
+		edits, tree = css_patch.patch(source, [update('b', [('x', '1', 0), ('color', '1', 2)])])
+		self.assertEqual(css_patch.apply_edits(source, edits), 'b{x:1;color:1;margin:3}')
+		self.assertEqual(properties(tree), [[('x', '1'), ('color', '1'), ('margin', '3')]])
+
+if __name__ == '__main__':
+	unittest.main()
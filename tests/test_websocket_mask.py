@@ -0,0 +1,41 @@
+"""
+Checks websocket payload unmasking against byte-by-byte implementation.
+Run as `python -m tests.test_websocket_mask [size_kb]` to benchmark both
+"""
+
+import os
+import sys
+import array
+import timeit
+import unittest
+
+from tornado.websocket import _apply_mask
+
+def apply_mask_bytewise(mask, data):
+	"Reference implementation of `_apply_mask`, one byte at a time"
+	mask = array.array('B', mask)
+	unmasked = array.array('B', data)
+	for i in range(len(data)):
+		unmasked[i] = unmasked[i] ^ mask[i % 4]
+	return unmasked.tobytes() if hasattr(unmasked, 'tobytes') else unmasked.tostring()
+
+class ApplyMaskTest(unittest.TestCase):
+	def test_same_as_bytewise(self):
+		mask = os.urandom(4)
+		for size in (0, 1, 3, 4, 5, 125, 126, 65536 + 3):
+			data = os.urandom(size)
+			self.assertEqual(_apply_mask(mask, data), apply_mask_bytewise(mask, data))
+
+	def test_leading_zero_bytes(self):
+		self.assertEqual(_apply_mask(b'\x00\x00\x00\x00', b'\x00\x00a'), b'\x00\x00a')
+		self.assertEqual(_apply_mask(b'abcd', b'abcda'), b'\x00\x00\x00\x00\x00')
+
+def benchmark(size_kb):
+	mask = os.urandom(4)
+	data = os.urandom(size_kb * 1024)
+	for name, fn, number in (('word-wide', _apply_mask, 20), ('bytewise', apply_mask_bytewise, 1)):
+		best = min(timeit.repeat(lambda: fn(mask, data), number=number, repeat=3)) / number
+		print('%-10s %8.2f ms per %d KB, %8.1f MB/s' % (name, best * 1000, size_kb, size_kb / 1024.0 / best))
+
+if __name__ == '__main__':
+	benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1024)
@@ -46,6 +46,25 @@ try:
 except ImportError:
     _set_nonblocking = None
 
+try:
+    memoryview  # py27+
+except NameError:
+    def _slice_bytes(buf, start, end):
+        return bytes_type(buf[start:end])
+else:
+    def _slice_bytes(buf, start, end):
+        # copies the slice once, bytearray slicing would copy it twice
+        return memoryview(buf)[start:end].tobytes()
+
+# Maximum amount of data passed to a single send call
+_WRITE_CHUNK_SIZE = 128 * 1024
+
+# Maximum number of buffers passed to a single sendmsg call
+try:
+    _MAX_WRITE_BUFFERS = min(os.sysconf('SC_IOV_MAX'), 64)
+except (AttributeError, ValueError, OSError):
+    _MAX_WRITE_BUFFERS = 16
+
 
 class StreamClosedError(IOError):
     """Exception raised by `IOStream` methods when the stream is closed.
@@ -76,8 +95,15 @@ class BaseIOStream(object):
         self.max_buffer_size = max_buffer_size or 104857600
         self.read_chunk_size = read_chunk_size
         self.error = None
-        self._read_buffer = collections.deque()
+        # Read buffer is a single bytearray: new data is appended to its
+        # end and consumed data is skipped by moving `_read_buffer_pos`.
+        # Consumed prefix is dropped once it outgrows unread data
+        self._read_buffer = bytearray()
+        self._read_buffer_pos = 0
         self._write_buffer = collections.deque()
+        # number of bytes of the first write buffer already sent
+        # by vectored write
+        self._write_buffer_pos = 0
         self._read_buffer_size = 0
         self._write_buffer_frozen = False
         self._read_delimiter = None
@@ -113,6 +139,19 @@ class BaseIOStream(object):
         """
         raise NotImplementedError()
 
+    def write_to_fd_vectored(self, buffers):
+        """Attempts to write a list of buffers to the underlying file
+        with a single call, without joining them.
+
+        Returns the number of bytes written.  Only called if
+        `can_write_vectored` returns True.
+        """
+        raise NotImplementedError()
+
+    def can_write_vectored(self):
+        """Returns True if stream supports `write_to_fd_vectored`."""
+        return False
+
     def read_from_fd(self):
         """Attempts to read from the underlying file.
 
@@ -208,11 +247,12 @@ class BaseIOStream(object):
         if data:
             # Break up large contiguous strings before inserting them in the
             # write buffer, so we don't have to recopy the entire thing
-            # as we slice off pieces to send to the socket.
-            WRITE_BUFFER_CHUNK_SIZE = 128 * 1024
-            if len(data) > WRITE_BUFFER_CHUNK_SIZE:
-                for i in range(0, len(data), WRITE_BUFFER_CHUNK_SIZE):
-                    self._write_buffer.append(data[i:i + WRITE_BUFFER_CHUNK_SIZE])
+            # as we slice off pieces to send to the socket.  Vectored
+            # writes send buffers from an offset and don't need this.
+            if (len(data) > _WRITE_CHUNK_SIZE and
+                    not self.can_write_vectored()):
+                for i in range(0, len(data), _WRITE_CHUNK_SIZE):
+                    self._write_buffer.append(data[i:i + _WRITE_CHUNK_SIZE])
             else:
                 self._write_buffer.append(data)
         self._write_callback = stack_context.wrap(callback)
@@ -457,7 +497,7 @@ class BaseIOStream(object):
             raise
         if chunk is None:
             return 0
-        self._read_buffer.append(chunk)
+        self._read_buffer += chunk
         self._read_buffer_size += len(chunk)
         if self._read_buffer_size >= self.max_buffer_size:
             gen_log.error("Reached maximum read buffer size")
@@ -486,55 +526,47 @@ class BaseIOStream(object):
             self._run_callback(callback, self._consume(num_bytes))
             return True
         elif self._read_delimiter is not None:
-            # Multi-byte delimiters (e.g. '\r\n') may straddle two
-            # chunks in the read buffer, so we can't easily find them
-            # without collapsing the buffer.  However, since protocols
-            # using delimited reads (as opposed to reads of a known
-            # length) tend to be "line" oriented, the delimiter is likely
-            # to be in the first few chunks.  Merge the buffer gradually
-            # since large merges are relatively expensive and get undone in
-            # consume().
-            if self._read_buffer:
-                while True:
-                    loc = self._read_buffer[0].find(self._read_delimiter)
-                    if loc != -1:
-                        callback = self._read_callback
-                        delimiter_len = len(self._read_delimiter)
-                        self._read_callback = None
-                        self._streaming_callback = None
-                        self._read_delimiter = None
-                        self._run_callback(callback,
-                                           self._consume(loc + delimiter_len))
-                        return True
-                    if len(self._read_buffer) == 1:
-                        break
-                    _double_prefix(self._read_buffer)
+            if self._read_buffer_size:
+                loc = self._read_buffer.find(self._read_delimiter,
+                                             self._read_buffer_pos)
+                if loc != -1:
+                    callback = self._read_callback
+                    delimiter_len = len(self._read_delimiter)
+                    self._read_callback = None
+                    self._streaming_callback = None
+                    self._read_delimiter = None
+                    self._run_callback(callback, self._consume(
+                        loc - self._read_buffer_pos + delimiter_len))
+                    return True
         elif self._read_regex is not None:
-            if self._read_buffer:
-                while True:
-                    m = self._read_regex.search(self._read_buffer[0])
-                    if m is not None:
-                        callback = self._read_callback
-                        self._read_callback = None
-                        self._streaming_callback = None
-                        self._read_regex = None
-                        self._run_callback(callback, self._consume(m.end()))
-                        return True
-                    if len(self._read_buffer) == 1:
-                        break
-                    _double_prefix(self._read_buffer)
+            if self._read_buffer_size:
+                m = self._read_regex.search(self._read_buffer,
+                                            self._read_buffer_pos)
+                if m is not None:
+                    callback = self._read_callback
+                    self._read_callback = None
+                    self._streaming_callback = None
+                    self._read_regex = None
+                    self._run_callback(callback, self._consume(
+                        m.end() - self._read_buffer_pos))
+                    return True
         return False
 
     def _handle_write(self):
+        vectored = self.can_write_vectored()
         while self._write_buffer:
             try:
+                if vectored:
+                    if self._write_vectored() == 0:
+                        break
+                    continue
                 if not self._write_buffer_frozen:
                     # On windows, socket.send blows up if given a
                     # write buffer that's too large, instead of just
                     # returning the number of bytes it was able to
                     # process.  Therefore we must not call socket.send
                     # with more than 128KB at a time.
-                    _merge_prefix(self._write_buffer, 128 * 1024)
+                    _merge_prefix(self._write_buffer, _WRITE_CHUNK_SIZE)
                 num_bytes = self.write_to_fd(self._write_buffer[0])
                 if num_bytes == 0:
                     # With OpenSSL, if we couldn't write the entire buffer,
@@ -568,12 +600,43 @@ class BaseIOStream(object):
             self._write_callback = None
             self._run_callback(callback)
 
+    def _write_vectored(self):
+        """Sends pending write buffers with a single vectored write.
+
+        Buffers are passed to the socket as is, partially sent first
+        buffer is resumed from `_write_buffer_pos` offset instead of
+        being sliced.  Returns the number of bytes written.
+        """
+        buffers = []
+        size = -self._write_buffer_pos
+        for chunk in self._write_buffer:
+            if len(buffers) == _MAX_WRITE_BUFFERS or size >= _WRITE_CHUNK_SIZE:
+                break
+            buffers.append(chunk)
+            size += len(chunk)
+        if self._write_buffer_pos:
+            buffers[0] = memoryview(buffers[0])[self._write_buffer_pos:]
+        num_bytes = self.write_to_fd_vectored(buffers)
+        sent = self._write_buffer_pos + num_bytes
+        while self._write_buffer and sent >= len(self._write_buffer[0]):
+            sent -= len(self._write_buffer.popleft())
+        self._write_buffer_pos = sent
+        return num_bytes
+
     def _consume(self, loc):
         if loc == 0:
             return b""
-        _merge_prefix(self._read_buffer, loc)
+        assert loc <= self._read_buffer_size
+        pos = self._read_buffer_pos
+        data = _slice_bytes(self._read_buffer, pos, pos + loc)
+        self._read_buffer_pos += loc
         self._read_buffer_size -= loc
-        return self._read_buffer.popleft()
+        # drop consumed prefix only when it's larger than unread data,
+        # which keeps compaction cost amortized O(1) per byte
+        if self._read_buffer_pos > self._read_buffer_size:
+            del self._read_buffer[:self._read_buffer_pos]
+            self._read_buffer_pos = 0
+        return data
 
     def _check_closed(self):
         if self.closed():
@@ -694,6 +757,13 @@ class IOStream(BaseIOStream):
     def write_to_fd(self, data):
         return self.socket.send(data)
 
+    def write_to_fd_vectored(self, buffers):
+        return self.socket.sendmsg(buffers)
+
+    def can_write_vectored(self):
+        # socket.sendmsg is available in py33+ on Unix
+        return self.socket is not None and hasattr(self.socket, 'sendmsg')
+
     def connect(self, address, callback=None, server_hostname=None):
         """Connects the socket to a remote address without blocking.
 
@@ -877,6 +947,10 @@ class SSLIOStream(IOStream):
             return
         super(SSLIOStream, self)._handle_write()
 
+    def can_write_vectored(self):
+        # SSL sockets don't support sendmsg
+        return False
+
     def connect(self, address, callback=None, server_hostname=None):
         # Save the user's callback and run it after the ssl handshake
         # has completed.
@@ -968,15 +1042,6 @@ class PipeIOStream(BaseIOStream):
         return chunk
 
 
-def _double_prefix(deque):
-    """Grow by doubling, but don't split the second chunk just because the
-    first one is small.
-    """
-    new_len = max(len(deque[0]) * 2,
-                  (len(deque[0]) + len(deque[1])))
-    _merge_prefix(deque, new_len)
-
-
 def _merge_prefix(deque, size):
     """Replace the first entries in a deque of strings with a single
     string of up to size bytes.
@@ -20,14 +20,15 @@ communication between the browser and server.
 from __future__ import absolute_import, division, print_function, with_statement
 # Author: Jacob Kristhammar, 2010
 
-import array
 import base64
+import binascii
 import collections
 import functools
 import hashlib
 import os
 import struct
 import time
+import zlib
 import tornado.escape
 import tornado.web
 
@@ -46,11 +47,29 @@ try:
 except NameError:
     xrange = range  # py3
 
+if hasattr(int, 'from_bytes'):
+    def _bytes_to_int(data):
+        return int.from_bytes(data, 'big')
+
+    def _int_to_bytes(value, length):
+        return value.to_bytes(length, 'big')
+else:
+    # py2: hex conversions of longs are linear in data size
+    def _bytes_to_int(data):
+        return int(binascii.hexlify(data), 16)
+
+    def _int_to_bytes(value, length):
+        return binascii.unhexlify('%0*x' % (length * 2, value))
+
 
 class WebSocketError(Exception):
     pass
 
 
+# Default limit for size of incoming messages, in bytes
+_default_max_message_size = 10 * 1024 * 1024
+
+
 class WebSocketHandler(tornado.web.RequestHandler):
     """Subclass this class to create a basic WebSocket handler.
 
@@ -103,6 +122,17 @@ class WebSocketHandler(tornado.web.RequestHandler):
         self.stream = request.connection.stream
         self.ws_connection = None
 
+    @property
+    def max_message_size(self):
+        """Maximum allowed size of incoming message, in bytes.
+
+        Connection is closed once a client sends a larger message.
+        Set with the ``websocket_max_message_size`` application
+        setting, ``None`` or 0 means no limit.
+        """
+        return self.settings.get('websocket_max_message_size',
+                                 _default_max_message_size)
+
     def _execute(self, transforms, *args, **kwargs):
         self.open_args = args
         self.open_kwargs = kwargs
@@ -140,7 +170,9 @@ class WebSocketHandler(tornado.web.RequestHandler):
         # client sends a "Sec-Websocket-Origin" header and in 13 it's
         # simply "Origin".
         if self.request.headers.get("Sec-WebSocket-Version") in ("7", "8", "13"):
-            self.ws_connection = WebSocketProtocol13(self)
+            self.ws_connection = WebSocketProtocol13(
+                self, compression_options=self.get_compression_options(),
+                max_message_size=self.max_message_size)
             self.ws_connection.accept_connection()
         elif (self.allow_draft76() and
               "Sec-WebSocket-Version" not in self.request.headers):
@@ -177,6 +209,25 @@ class WebSocketHandler(tornado.web.RequestHandler):
         """
         return None
 
+    def get_compression_options(self):
+        """Override to return compression options for the connection.
+
+        If this method returns None (the default), compression will
+        be disabled.  If it returns a dict (even an empty one), the
+        permessage-deflate extension (RFC 7692) will be enabled if the
+        client offers it.  Supported options are:
+
+        * ``compression_level``: zlib compression level, 6 by default
+        * ``min_size``: messages shorter than this number of bytes
+          are sent uncompressed, 0 by default
+        * ``no_context_takeover``: if true, the server will not reuse
+          compression context between messages.  This uses more
+          bandwidth but less memory per connection, and makes
+          compressed frames of the same message identical for every
+          connection, so a broadcast can compress a message only once.
+        """
+        return None
+
     def open(self):
         """Invoked when a new WebSocket is opened.
 
@@ -490,18 +541,28 @@ class WebSocketProtocol13(WebSocketProtocol):
     """Implementation of the WebSocket protocol from RFC 6455.
 
     This class supports versions 7 and 8 of the protocol in addition to the
-    final version 13.
+    final version 13, and the permessage-deflate extension (RFC 7692).
     """
-    def __init__(self, handler, mask_outgoing=False):
+    # Bit used by permessage-deflate to mark compressed messages
+    RSV1 = 0x40
+    def __init__(self, handler, mask_outgoing=False, compression_options=None,
+                 max_message_size=_default_max_message_size):
         WebSocketProtocol.__init__(self, handler)
         self.mask_outgoing = mask_outgoing
+        self._max_message_size = max_message_size
+        self._compression_options = compression_options
+        self._compressor = None
+        self._decompressor = None
         self._final_frame = False
         self._frame_opcode = None
+        self._frame_compressed = None
         self._masked_frame = None
         self._frame_mask = None
         self._frame_length = None
         self._fragmented_message_buffer = None
+        self._fragmented_message_size = 0
         self._fragmented_message_opcode = None
+        self._fragmented_message_compressed = None
         self._waiting = None
 
     def accept_connection(self):
@@ -547,23 +608,92 @@ class WebSocketProtocol13(WebSocketProtocol):
                 assert selected in subprotocols
                 subprotocol_header = "Sec-WebSocket-Protocol: %s\r\n" % selected
 
+        extension_header = ''
+        if self._compression_options is not None:
+            extensions = _parse_extensions_header(
+                self.request.headers.get("Sec-WebSocket-Extensions", ''))
+            for name, params in extensions:
+                if name != 'permessage-deflate':
+                    continue
+                agreed = self._agree_deflate_parameters(params)
+                if agreed is not None:
+                    self._create_compressors('server', agreed)
+                    extension_header = ("Sec-WebSocket-Extensions: %s\r\n" %
+                                        _encode_extension(name, agreed))
+                    break
+
         self.stream.write(tornado.escape.utf8(
             "HTTP/1.1 101 Switching Protocols\r\n"
             "Upgrade: websocket\r\n"
             "Connection: Upgrade\r\n"
             "Sec-WebSocket-Accept: %s\r\n"
-            "%s"
-            "\r\n" % (self._challenge_response(), subprotocol_header)))
+            "%s%s"
+            "\r\n" % (self._challenge_response(), subprotocol_header,
+                       extension_header)))
 
         self.async_callback(self.handler.open)(*self.handler.open_args, **self.handler.open_kwargs)
         self._receive_frame()
 
-    def _write_frame(self, fin, opcode, data):
+    def _agree_deflate_parameters(self, params):
+        """Returns permessage-deflate parameters accepted by the server
+        for the given client offer, or None to decline the offer.
+        """
+        agreed = {}
+        for key, value in params.items():
+            if key in ('server_no_context_takeover',
+                       'client_no_context_takeover'):
+                if value is not None:
+                    return None
+                agreed[key] = None
+            elif key in ('server_max_window_bits', 'client_max_window_bits'):
+                if value is None:
+                    # client only announces it supports this parameter
+                    if key == 'client_max_window_bits':
+                        continue
+                    return None
+                try:
+                    bits = int(value)
+                except ValueError:
+                    return None
+                # zlib can't produce raw deflate streams with 256-byte window
+                if not 9 <= bits <= 15:
+                    return None
+                agreed[key] = str(bits)
+            else:
+                return None
+
+        if self._compression_options.get('no_context_takeover'):
+            agreed['server_no_context_takeover'] = None
+        return agreed
+
+    def _compressor_options(self, side, agreed):
+        bits = agreed.get(side + '_max_window_bits')
+        return dict(
+            persistent=(side + '_no_context_takeover') not in agreed,
+            max_wbits=zlib.MAX_WBITS if bits is None else int(bits))
+
+    def _create_compressors(self, side, agreed):
+        other_side = 'client' if side == 'server' else 'server'
+        options = self._compression_options or {}
+        self._compressor = _PerMessageDeflateCompressor(
+            compression_level=options.get('compression_level', 6),
+            min_size=options.get('min_size', 0),
+            **self._compressor_options(side, agreed))
+        self._decompressor = _PerMessageDeflateDecompressor(
+            **self._compressor_options(other_side, agreed))
+
+    def _build_frame(self, fin, opcode, data, flags=0):
+        """Returns bytes of a single frame with given payload.
+
+        Frames built by a connection that doesn't mask outgoing data
+        can be written as is to any other such connection, which
+        allows broadcasting a message without re-framing it per client.
+        """
         if fin:
             finbit = 0x80
         else:
             finbit = 0
-        frame = struct.pack("B", finbit | opcode)
+        frame = struct.pack("B", finbit | flags | opcode)
         l = len(data)
         if self.mask_outgoing:
             mask_bit = 0x80
@@ -579,18 +709,50 @@ class WebSocketProtocol13(WebSocketProtocol):
             mask = os.urandom(4)
             data = mask + self._apply_mask(mask, data)
         frame += data
-        self.stream.write(frame)
+        return frame
 
-    def write_message(self, message, binary=False):
-        """Sends the given message to the client of this Web Socket."""
-        if binary:
-            opcode = 0x2
-        else:
-            opcode = 0x1
+    def _write_frame(self, fin, opcode, data, flags=0):
+        self.stream.write(self._build_frame(fin, opcode, data, flags))
+
+    def _build_message_frame(self, message, binary=False):
+        """Returns frame bytes of the given message, compressed
+        if compression is negotiated for this connection.
+        """
+        opcode = 0x2 if binary else 0x1
         message = tornado.escape.utf8(message)
         assert isinstance(message, bytes_type)
+        flags = 0
+        if self._compressor is not None and self._compressor.accepts(message):
+            message = self._compressor.compress(message)
+            flags |= self.RSV1
+        return self._build_frame(True, opcode, message, flags)
+
+    def frame_cache_key(self):
+        """Returns a key identifying frames produced by this connection.
+
+        Connections with equal keys produce identical frames for the
+        same message, so a frame built by one of them can be written
+        to the others.  None means frames are connection-specific.
+        """
+        if self.mask_outgoing:
+            return None
+        if self._compressor is None:
+            return 'plain'
+        return self._compressor.cache_key()
+
+    def write_frame(self, frame):
+        """Writes frame bytes built by `_build_frame` to the client."""
+        assert isinstance(frame, bytes_type)
         try:
-            self._write_frame(True, opcode, message)
+            self.stream.write(frame)
+        except StreamClosedError:
+            self._abort()
+
+    def write_message(self, message, binary=False):
+        """Sends the given message to the client of this Web Socket."""
+        frame = self._build_message_frame(message, binary)
+        try:
+            self.stream.write(frame)
         except StreamClosedError:
             self._abort()
 
@@ -611,6 +773,15 @@ class WebSocketProtocol13(WebSocketProtocol):
         reserved_bits = header & 0x70
         self._frame_opcode = header & 0xf
         self._frame_opcode_is_control = self._frame_opcode & 0x8
+        self._frame_compressed = False
+        if self._decompressor is not None and reserved_bits & self.RSV1:
+            # compression flag is only allowed on the first
+            # frame of a data message
+            if self._frame_opcode_is_control or self._frame_opcode == 0:
+                self._abort()
+                return
+            self._frame_compressed = True
+            reserved_bits &= ~self.RSV1
         if reserved_bits:
             # client is using as-yet-undefined extensions; abort
             self._abort()
@@ -624,10 +795,7 @@ class WebSocketProtocol13(WebSocketProtocol):
         try:
             if payloadlen < 126:
                 self._frame_length = payloadlen
-                if self._masked_frame:
-                    self.stream.read_bytes(4, self._on_masking_key)
-                else:
-                    self.stream.read_bytes(self._frame_length, self._on_frame_data)
+                self._read_frame_payload()
             elif payloadlen == 126:
                 self.stream.read_bytes(2, self._on_frame_length_16)
             elif payloadlen == 127:
@@ -638,23 +806,33 @@ class WebSocketProtocol13(WebSocketProtocol):
     def _on_frame_length_16(self, data):
         self._frame_length = struct.unpack("!H", data)[0]
         try:
-            if self._masked_frame:
-                self.stream.read_bytes(4, self._on_masking_key)
-            else:
-                self.stream.read_bytes(self._frame_length, self._on_frame_data)
+            self._read_frame_payload()
         except StreamClosedError:
             self._abort()
 
     def _on_frame_length_64(self, data):
         self._frame_length = struct.unpack("!Q", data)[0]
         try:
-            if self._masked_frame:
-                self.stream.read_bytes(4, self._on_masking_key)
-            else:
-                self.stream.read_bytes(self._frame_length, self._on_frame_data)
+            self._read_frame_payload()
         except StreamClosedError:
             self._abort()
 
+    def _read_frame_payload(self):
+        size = self._frame_length
+        if self._frame_opcode == 0:
+            size += self._fragmented_message_size
+        if (self._max_message_size and size > self._max_message_size and
+                not self._frame_opcode_is_control):
+            # message is too large, abort before reading its payload
+            gen_log.info("WebSocket message exceeds %d bytes, closing",
+                         self._max_message_size)
+            self._abort()
+            return
+        if self._masked_frame:
+            self.stream.read_bytes(4, self._on_masking_key)
+        else:
+            self.stream.read_bytes(self._frame_length, self._on_frame_data)
+
     def _on_masking_key(self, data):
         self._frame_mask = data
         try:
@@ -663,17 +841,7 @@ class WebSocketProtocol13(WebSocketProtocol):
             self._abort()
 
     def _apply_mask(self, mask, data):
-        mask = array.array("B", mask)
-        unmasked = array.array("B", data)
-        for i in xrange(len(data)):
-            unmasked[i] = unmasked[i] ^ mask[i % 4]
-        if hasattr(unmasked, 'tobytes'):
-            # tostring was deprecated in py32.  It hasn't been removed,
-            # but since we turn on deprecation warnings in our tests
-            # we need to use the right one.
-            return unmasked.tobytes()
-        else:
-            return unmasked.tostring()
+        return _apply_mask(mask, data)
 
     def _on_masked_frame_data(self, data):
         self._on_frame_data(self._apply_mask(self._frame_mask, data))
@@ -693,11 +861,16 @@ class WebSocketProtocol13(WebSocketProtocol):
                 # nothing to continue
                 self._abort()
                 return
-            self._fragmented_message_buffer += data
+            # fragments are joined once the message is complete,
+            # growing a single string is quadratic
+            self._fragmented_message_buffer.append(data)
+            self._fragmented_message_size += len(data)
             if self._final_frame:
                 opcode = self._fragmented_message_opcode
-                data = self._fragmented_message_buffer
+                compressed = self._fragmented_message_compressed
+                data = b"".join(self._fragmented_message_buffer)
                 self._fragmented_message_buffer = None
+                self._fragmented_message_size = 0
         else:  # start of new data message
             if self._fragmented_message_buffer is not None:
                 # can't start new message until the old one is finished
@@ -705,11 +878,25 @@ class WebSocketProtocol13(WebSocketProtocol):
                 return
             if self._final_frame:
                 opcode = self._frame_opcode
+                compressed = self._frame_compressed
             else:
                 self._fragmented_message_opcode = self._frame_opcode
-                self._fragmented_message_buffer = data
+                self._fragmented_message_compressed = self._frame_compressed
+                self._fragmented_message_buffer = [data]
+                self._fragmented_message_size = len(data)
 
         if self._final_frame:
+            if self._frame_opcode_is_control:
+                compressed = False
+            if compressed:
+                try:
+                    data = self._decompressor.decompress(
+                        data, self._max_message_size)
+                except (zlib.error, ValueError):
+                    gen_log.info("Invalid compressed WebSocket message",
+                                 exc_info=True)
+                    self._abort()
+                    return
             self._handle_message(opcode, data)
 
         if not self.client_terminated:
@@ -761,9 +948,121 @@ class WebSocketProtocol13(WebSocketProtocol):
                 self.stream.io_loop.time() + 5, self._abort)
 
 
+def _apply_mask(mask, data):
+    """Applies 4-byte websocket mask to data.
+
+    Data and repeated mask are XORed as two big integers, which
+    processes the whole payload in C instead of byte by byte.
+    """
+    length = len(data)
+    if not length:
+        return b""
+    mask = (mask * (length // 4 + 1))[:length]
+    return _int_to_bytes(_bytes_to_int(data) ^ _bytes_to_int(mask), length)
+
+
+def _parse_extensions_header(value):
+    """Parses ``Sec-WebSocket-Extensions`` header value into a list
+    of ``(name, params)`` tuples.  Parameters without value are
+    mapped to None.
+    """
+    extensions = []
+    for item in value.split(','):
+        parts = [p.strip() for p in item.split(';')]
+        if not parts[0]:
+            continue
+        params = {}
+        for part in parts[1:]:
+            if not part:
+                continue
+            if '=' in part:
+                key, val = part.split('=', 1)
+                val = val.strip()
+                if len(val) >= 2 and val[0] == val[-1] == '"':
+                    val = val[1:-1]
+                params[key.strip().lower()] = val
+            else:
+                params[part.lower()] = None
+        extensions.append((parts[0].lower(), params))
+    return extensions
+
+
+def _encode_extension(name, params):
+    """Encodes extension with its parameters for
+    ``Sec-WebSocket-Extensions`` header.
+    """
+    out = [name]
+    for key in sorted(params):
+        value = params[key]
+        out.append(key if value is None else '%s=%s' % (key, value))
+    return '; '.join(out)
+
+
+class _PerMessageDeflateCompressor(object):
+    def __init__(self, persistent, max_wbits, compression_level=6, min_size=0):
+        self._max_wbits = max_wbits
+        self._compression_level = compression_level
+        self._min_size = min_size
+        self.persistent = persistent
+        if persistent:
+            self._compressor = self._create_compressor()
+        else:
+            self._compressor = None
+
+    def _create_compressor(self):
+        return zlib.compressobj(self._compression_level, zlib.DEFLATED,
+                                -self._max_wbits)
+
+    def accepts(self, data):
+        """Returns true if the given message should be compressed."""
+        return len(data) >= self._min_size
+
+    def cache_key(self):
+        """Returns a key of compressor settings if its output depends
+        on the message only, None otherwise.
+        """
+        if self.persistent:
+            return None
+        return ('deflate', self._compression_level, self._max_wbits,
+                self._min_size)
+
+    def compress(self, data):
+        compressor = self._compressor or self._create_compressor()
+        data = (compressor.compress(data) +
+                compressor.flush(zlib.Z_SYNC_FLUSH))
+        assert data.endswith(b'\x00\x00\xff\xff')
+        return data[:-4]
+
+
+class _PerMessageDeflateDecompressor(object):
+    def __init__(self, persistent, max_wbits):
+        self._max_wbits = max_wbits
+        if persistent:
+            self._decompressor = self._create_decompressor()
+        else:
+            self._decompressor = None
+
+    def _create_decompressor(self):
+        return zlib.decompressobj(-self._max_wbits)
+
+    def decompress(self, data, max_length=None):
+        """Decompresses message, raises ValueError if decompressed
+        data exceeds ``max_length`` bytes.
+        """
+        decompressor = self._decompressor or self._create_decompressor()
+        # decompress a byte more than allowed to detect overflow
+        result = decompressor.decompress(data + b'\x00\x00\xff\xff',
+                                         max_length + 1 if max_length else 0)
+        if max_length and len(result) > max_length:
+            raise ValueError("Decompressed message exceeds %d bytes" %
+                             max_length)
+        return result
+
+
 class WebSocketClientConnection(simple_httpclient._HTTPConnection):
     """WebSocket client connection."""
-    def __init__(self, io_loop, request):
+    def __init__(self, io_loop, request, compression_options=None):
+        self.compression_options = compression_options
         self.connect_future = Future()
         self.read_future = None
         self.read_queue = collections.deque()
@@ -778,6 +1077,9 @@ class WebSocketClientConnection(simple_httpclient._HTTPConnection):
             'Sec-WebSocket-Key': self.key,
             'Sec-WebSocket-Version': '13',
         })
+        if compression_options is not None:
+            request.headers['Sec-WebSocket-Extensions'] = (
+                'permessage-deflate; client_max_window_bits')
 
         self.resolver = Resolver(io_loop=io_loop)
         super(WebSocketClientConnection, self).__init__(
@@ -803,7 +1105,16 @@ class WebSocketClientConnection(simple_httpclient._HTTPConnection):
         accept = WebSocketProtocol13.compute_accept_value(self.key)
         assert self.headers['Sec-Websocket-Accept'] == accept
 
-        self.protocol = WebSocketProtocol13(self, mask_outgoing=True)
+        self.protocol = WebSocketProtocol13(
+            self, mask_outgoing=True,
+            compression_options=self.compression_options)
+        extensions = _parse_extensions_header(
+            self.headers.get('Sec-WebSocket-Extensions', ''))
+        for name, params in extensions:
+            if name == 'permessage-deflate' and self.compression_options is not None:
+                self.protocol._create_compressors('client', params)
+            else:
+                raise ValueError("unsupported extension %r" % name)
         self.protocol._receive_frame()
 
         if self._timeout is not None:
@@ -845,18 +1156,21 @@ class WebSocketClientConnection(simple_httpclient._HTTPConnection):
         pass
 
 
-def websocket_connect(url, io_loop=None, callback=None, connect_timeout=None):
+def websocket_connect(url, io_loop=None, callback=None, connect_timeout=None,
+                      compression_options=None):
     """Client-side websocket support.
 
     Takes a url and returns a Future whose result is a
-    `WebSocketClientConnection`.
+    `WebSocketClientConnection`.  ``compression_options`` is
+    interpreted in the same way as the return value of
+    `.WebSocketHandler.get_compression_options`.
     """
     if io_loop is None:
         io_loop = IOLoop.current()
     request = httpclient.HTTPRequest(url, connect_timeout=connect_timeout)
     request = httpclient._RequestProxy(
         request, httpclient.HTTPRequest._DEFAULTS)
-    conn = WebSocketClientConnection(io_loop, request)
+    conn = WebSocketClientConnection(io_loop, request, compression_options)
     if callback is not None:
         io_loop.add_future(conn.connect_future, callback)
     return conn.connect_future